@@ -0,0 +1,47 @@
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import pytest
+
+import t_helpers
+from t_helpers import TreeSnapshot
+
+
+@pytest.fixture(scope="session", autouse=True)
+def log_capture(request):
+    """Installs the handlers through which main_with_log() captures what main() logs.  The
+    output is only echoed to stdout when pytest is not capturing stdout itself (-s)."""
+    t_helpers.mirror_to_stdout = request.config.getoption("capture") == "no"
+    root_logger = logging.getLogger()
+    previous_level = root_logger.level
+    # The package's loggers leave their level unset, so setting the root logger is enough
+    # for all of them to pass DEBUG records on to the handlers.
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(t_helpers.capture_queue_handler)
+    t_helpers.capture_listener.start()
+    try:
+        yield
+    finally:
+        root_logger.removeHandler(t_helpers.capture_queue_handler)
+        t_helpers.capture_listener.stop()
+        root_logger.setLevel(previous_level)
+
+
+@pytest.fixture(scope="session")
+def calculated_resources(tmp_path_factory, log_capture) -> TreeSnapshot:
+    """A snapshot of tests/resources, along with its --calculate --detail-files record,
+    made once per session for tests to clone."""
+    resources_path = Path(__file__).parent / "resources"
+    return TreeSnapshot(resources_path, tmp_path_factory.mktemp("snapshot") / "resources", ["--detail-files"])
+
+
+@pytest.fixture
+def cloned_trees(tmp_path, calculated_resources) -> Tuple[Path, Path]:
+    """Two clones, A and B, of calculated_resources, along with its record, in the test's own
+    temporary directory."""
+    temp_path_A = tmp_path / "tempA"
+    temp_path_B = tmp_path / "tempB"
+    calculated_resources.clone(temp_path_A)
+    calculated_resources.clone(temp_path_B)
+    return temp_path_A, temp_path_B
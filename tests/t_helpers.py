@@ -1,119 +1,352 @@
+import hashlib
+import io
+import json
 import logging
 import os
+import queue
+import re
+import shutil
 import sys
-from io import StringIO
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Union
+from typing import Callable, Optional, Tuple, Union
 
 from tree_inventory import main
 
 PathOrStr = Union[Path, str]
 
+# Whether main_with_log() echoes what it captures to stdout.  conftest.py turns this
+# off when pytest is capturing stdout anyway, leaving it on only when run with -s.
+mirror_to_stdout = True
+
 
 def write_text_to_file(fname: PathOrStr, new_text: str):
-    """Simply writes text into a file, overwriting the file."""
-    dir = Path(fname).parent
-    if not dir.exists():
-        dir.mkdir(parents=True)
-    with open(str(fname), "wt") as fh:
-        fh.write(new_text)
+    """Simply writes text into a file, overwriting the file.  If the file is
+    a hardlink into a TreeSnapshot, the link is broken first so that the
+    snapshot is left untouched.  When overwriting, the modification time is
+    guaranteed to move forward even if the filesystem's clock resolution
+    would otherwise leave it unchanged."""
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        previous: Optional[os.stat_result] = os.stat(fname)
+    except FileNotFoundError:
+        previous = None
+    if previous is not None and previous.st_nlink > 1:
+        os.unlink(fname)
+    Path(fname).write_bytes(new_text.encode("utf-8"))
+    if previous is not None and os.stat(fname).st_mtime_ns <= previous.st_mtime_ns:
+        bumped_ns = previous.st_mtime_ns + 2_000_000_000
+        os.utime(fname, ns=(bumped_ns, bumped_ns))
+
+
+def digest_tree(root: Path) -> dict:
+    """Returns the MD5 of every file under root, keyed by relative path."""
+    digests = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            pathname = Path(dirpath) / name
+            digests[str(pathname.relative_to(root))] = hashlib.md5(pathname.read_bytes()).hexdigest()
+    return digests
+
+
+class TreeSnapshot:
+    """A pristine copy of a tree that tests can clone cheaply.  Files in a clone
+    are hardlinks to the snapshot, so a test must not modify them in place
+    (write_text_to_file() takes care of this).  The snapshot's contents are
+    checked against the digests taken when it was made before each clone, and
+    the snapshot is rebuilt if anything has written through a link.
+
+    If calculate_options is given, the snapshot is also run through --calculate
+    (with those options) once when it is made, so that clones start out with a
+    record file that is already up-to-date.  The record file is copied rather
+    than linked into clones because --calculate rewrites it in place.
+    """
+
+    def __init__(self, source: Path, path: Path, calculate_options: Optional[list] = None):
+        self.source = source
+        self.path = path
+        self.calculate_options = calculate_options
+        self._build()
+
+    def _build(self):
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        shutil.copytree(self.source, self.path)
+        if self.calculate_options is not None:
+            main_with_log(["--calculate", str(self.path), "--new"] + self.calculate_options)
+        self.digests = digest_tree(self.path)
+
+    def clone(self, destination: Path):
+        if digest_tree(self.path) != self.digests:
+            self._build()
+        for dirpath, _, filenames in os.walk(self.path):
+            target_dir = destination / Path(dirpath).relative_to(self.path)
+            target_dir.mkdir(parents=True, exist_ok=True)
+            for name in filenames:
+                if name == "tree_checksum.json":
+                    shutil.copy2(Path(dirpath) / name, target_dir / name)
+                    continue
+                try:
+                    os.link(Path(dirpath) / name, target_dir / name)
+                except OSError:
+                    # Hardlinks might not be available, for example if the destination is on another volume.
+                    shutil.copy2(Path(dirpath) / name, target_dir / name)
+
+
+class ListHandler(logging.Handler):
+    """A logging handler that keeps each formatted record in a list, to
+    be joined into a single string once the caller is done logging."""
+
+    def __init__(self):
+        super().__init__()
+        self.records: list = []
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.records.append(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def getvalue(self) -> str:
+        return "".join(self.records)
+
+
+@contextmanager
+def buffered_stdout(buffer_size: int = 1 << 20):
+    """Yields a text stream that writes to sys.stdout's underlying binary
+    buffer in large blocks rather than a line at a time.  Everything written
+    is flushed when the context exits, and sys.stdout itself is left open.
+    """
+    binary = getattr(sys.stdout, "buffer", None)
+    if binary is None:
+        yield sys.stdout
+        return
+    sys.stdout.flush()
+    stream = io.TextIOWrapper(
+        io.BufferedWriter(binary, buffer_size=buffer_size),
+        encoding=sys.stdout.encoding,
+        errors="backslashreplace",
+    )
+    try:
+        yield stream
+    finally:
+        stream.flush()
+        stream.detach().detach()
+
+
+class _MirrorHandler(logging.StreamHandler):
+    """A StreamHandler that drops records while it has no stream to write to."""
+
+    def __init__(self):
+        super().__init__()
+        self.stream = None
+
+    def emit(self, record: logging.LogRecord):
+        if self.stream is not None:
+            super().emit(record)
+
+
+# The handlers are installed on the root logger once per session, by conftest.py's
+# log_capture fixture, rather than added and removed around every call to main().
+# Records pass through a queue so that main() does not wait on the console, and
+# _capture_log() clears and reads back _capture around each call.  Only one capture can
+# be in progress at a time, which _capture_lock enforces.  The level is set on
+# capture_queue_handler alone, by _capture_log(), since main() only raises the level of
+# the StreamHandlers it finds on the root logger for --v.
+_capture = ListHandler()
+_mirror = _MirrorHandler()
+_log_queue: queue.Queue = queue.Queue()
+capture_queue_handler = QueueHandler(_log_queue)
+capture_queue_handler.setLevel(logging.INFO)
+capture_listener = QueueListener(_log_queue, _capture, _mirror, respect_handler_level=True)
+_capture_lock = threading.Lock()
+
+
+def _verbose(args) -> bool:
+    return "--v" in args or "-v" in args
+
+
+def _capture_log(run: Callable[[], None], verbose: bool = False) -> list:
+    """Calls run() and returns the formatted records that were logged at INFO or
+    above while it ran, or at DEBUG or above if verbose, as for main() with --v.
+    This is the shared implementation of main_with_log() and its variants."""
+
+    if capture_queue_handler not in logging.getLogger().handlers:
+        raise RuntimeError("The log is only captured under pytest, by conftest.py's log_capture fixture.")
+    with _capture_lock, buffered_stdout() if mirror_to_stdout else nullcontext() as stdout_stream:
+        # Drop anything logged between calls.
+        _log_queue.join()
+        _capture.records = []
+        _mirror.setStream(stdout_stream)
+        capture_queue_handler.setLevel(logging.DEBUG if verbose else logging.INFO)
+        try:
+            run()
+        finally:
+            capture_queue_handler.setLevel(logging.INFO)
+            # Wait for the listener to handle everything that run() logged.
+            _log_queue.join()
+            _mirror.setStream(None)
+        return _capture.records
+
+
+def _error_in_log(description: str, log: str) -> RuntimeError:
+    return RuntimeError(
+        f"An error was observed when calling main.  Arguments were:\n{description}\nFull log follows: -------\n" + log
+    )
 
 
 def main_with_log(args, raise_on_error: bool = True) -> str:
     """Run main(), but capture everything that it outputs
-    to the console into the returned string.
+    to the console into the returned string.  Records are handed
+    to a QueueListener so that main() does not wait on the console
+    while it runs.  The output is also echoed to stdout if
+    mirror_to_stdout is set.
     """
+    ret_str = "".join(_capture_log(lambda: main(args), _verbose(args)))
+    if raise_on_error and "Error" in ret_str:
+        raise _error_in_log(f"main([{args}])", ret_str)
+    return ret_str
 
-    string_stream = StringIO()
-    handler1 = logging.StreamHandler(string_stream)
-    handler2 = logging.StreamHandler(stream=sys.stdout)
-    handler1.setLevel(logging.INFO)
-    handler2.setLevel(logging.INFO)
-    root_logger = logging.getLogger()
-    root_logger.addHandler(handler1)
-    root_logger.addHandler(handler2)
-    # for hh in root_logger.handlers:
-    # print(f"Handler: {hh}")
-    all_loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict]
-    for lg in all_loggers:
-        lg.setLevel(logging.DEBUG)
+
+def main_with_log_parallel(*arg_lists, raise_on_error: bool = True) -> str:
+    """As main_with_log(), but runs main() once for each list of arguments,
+    all at the same time on separate threads, and returns their combined
+    output.  The invocations must not operate on the same tree.
+    """
+
+    def run_all():
+        with ThreadPoolExecutor(len(arg_lists)) as executor:
+            for future in [executor.submit(main, args) for args in arg_lists]:
+                future.result()
+
+    ret_str = "".join(_capture_log(run_all, any(_verbose(args) for args in arg_lists)))
+    if raise_on_error and "Error" in ret_str:
+        raise _error_in_log("\n".join(f"main([{args}])" for args in arg_lists), ret_str)
+    return ret_str
+
+
+def main_with_parsed(args, base_A: Path, base_B: Path, raise_on_error: bool = True):
+    """Run main() for a --compare, as main_with_log() does, and parse its
+    output with CompareOutputParser.  The captured records are only walked
+    once, both to look for errors and to parse them.  Returns had_error,
+    file_mismatches, missing_A, missing_B.
+    """
+    records = _capture_log(lambda: main(args), _verbose(args))
+    parser = CompareOutputParser(base_A)
+    had_error = False
+    for record in records:
+        had_error = had_error or "Error" in record
+        parser.feed(record)
+    if raise_on_error and had_error:
+        raise _error_in_log(f"main([{args}])", "".join(records))
+    return (had_error, *parser.results())
+
+
+def main_with_events(args, raise_on_error: bool = True) -> Tuple[str, list]:
+    """Run main() for a --compare with --emit-events, and return both the
+    console output (as main_with_log() does) and the list of decoded events.
+    """
+    fd, events_path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
     try:
-        main(args)
-        handler1.flush()
-        handler2.flush()
-        ret_str = string_stream.getvalue()
-        if raise_on_error and "Error" in ret_str:
-            raise RuntimeError(
-                f"An error was observed when calling main.  Arguments were:\nmain([{args}])\nFull log follows: -------\n"
-                + ret_str
-            )
-        return ret_str
+        log = main_with_log(args + ["--emit-events", events_path], raise_on_error)
+        with open(events_path, "rt") as fh:
+            events = [json.loads(line) for line in fh]
     finally:
-        root_logger.removeHandler(handler1)
-        root_logger.removeHandler(handler2)
+        os.unlink(events_path)
+    return log, events
+
+
+def results_from_events(events: list):
+    """Reduce the events from main_with_events() to the same form as
+    main_with_parsed(): file_mismatches, missing_A, missing_B."""
+    file_mismatches = [event["path"] for event in events if event["event"] == "files-mismatch"]
+    absent = [event for event in events if event["event"] == "absent"]
+    missing_A = [event["name"] for event in absent if event["absent_from"] == "A"]
+    missing_B = [event["name"] for event in absent if event["absent_from"] == "B"]
+    return file_mismatches, missing_A, missing_B
+
 
+def path_key(path: Path) -> str:
+    """A normalized string for path, such that two paths that would refer to the
+    same file have equal keys.  No filesystem access is made, so symlinks are
+    not followed."""
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
 
-def samepath(A: Path, B: Path):
-    """Similar to os.path.samefile(), but does not require that the files actually exist
-    or be the same on disk.  This checks only that the paths would refer to the same
-    file."""
-    A_str = os.path.normcase(os.path.normpath(A.resolve()))
-    B_str = os.path.normcase(os.path.normpath(B.resolve()))
-    return A_str == B_str
 
+# The lines of --compare output that CompareOutputParser cares about:
+#   "A: <path>" naming the root of tree A,
+#   "<path> (A) vs <path> (B):" headers, indented by depth,
+#   "Directory '<name>' absent from A." (or B), and
+#   "Files within this folder mismatch."
+_COMPARE_MARKERS = re.compile(
+    r"^[ \t]*A:[ \t]*(?P<root>.*)$"
+    r"|^(?P<indent>[ \t]*)(?P<path>.*?) \(A\) vs .*$"
+    r"|^[^'\n]*'(?P<absent>.*)'[^'\n]*absent from (?P<side>[AB]).*$"
+    r"|^.*Files within this folder mismatch.*$",
+    re.MULTILINE,
+)
 
-def parse_results(text: str, base_A: Path, base_B: Path):
-    """Parse results of a comparison operation.  Tailored to the
-    text format of --compare.
+
+class CompareOutputParser:
+    """Parses the text format of --compare, which may be fed in as
+    many pieces as is convenient (for example, one log record at a
+    time) so long as each piece ends at the end of a line.
     """
 
-    file_mismatches = []
-    missing_A = []
-    missing_B = []
-
-    # Maintain 'current_A', a stack of the paths that have been listed.  Each entry in
-    # current_A is a tuple where the first entry is the indent for a path and the second
-    # is that absolute path itself.
-    current_A = [(0, base_A)]
-
-    lines = text.split("\n")
-    for iLine in range(len(lines)):
-        line = lines[iLine]
-        if line.lstrip().startswith("A:"):
-            iA = line.index("A:")
-            current_A = [(0, Path(line[iA + 2 :].lstrip()))]
-        if "vs" in line:
-            iA = line.index("(A)")
-            info = ""
-            try:
-                new_A = line[0:iA].strip()
-                new_indent = len(line[0:iA].rstrip()) - len(line[0:iA].strip())
-                info += f"line: {line}\n"
-                info += f"A substring: {line[0:iA]}\n"
-                info += f"new_indent = {new_indent}\n"
-                info += f"current_A before = {current_A}\n"
-                hypothetical_A = current_A[-1][1] / Path(new_A)
-                if new_indent != current_A[-1][0] or not samepath(current_A[-1][1], hypothetical_A):
-                    while new_indent <= current_A[-1][0]:
-                        info += f"last entry has indent {current_A[-1][0]} so moving up.\n"
-                        current_A = current_A[:-1]
-                    info += f"current_A now = {current_A}\n"
-                    current_A.append((new_indent, current_A[-1][1] / Path(new_A)))
-            except Exception as ex:
-                raise RuntimeError(
-                    f"With line:\n{line}\nA substring: {new_A}\nbase_A: {base_A}\n{info}" + str(ex)
-                ) from ex
-        if "Files within this folder mismatch" in line:
-            file_mismatches.append(str(current_A[-1][1].relative_to(base_A)))
-        if "absent from A" in line:
-            i_apos1 = line.index("'")
-            i_apos2 = line.rindex("'")
-            absent = line[i_apos1 + 1 : i_apos2]
-            missing_A.append(absent)
-        if "absent from B" in line:
-            i_apos1 = line.index("'")
-            i_apos2 = line.rindex("'")
-            absent = line[i_apos1 + 1 : i_apos2]
-            missing_B.append(absent)
+    def __init__(self, base_A: Path):
+        self.base_A = base_A
+        self.file_mismatches: list = []
+        self.missing_A: list = []
+        self.missing_B: list = []
 
-    return file_mismatches, missing_A, missing_B
+        # Maintain 'current_A', a stack of the paths that have been listed.  Each entry in
+        # current_A is a tuple where the first entry is the indent for a path, the second
+        # is that absolute path itself and the third is its path_key().
+        self.current_A = [(0, base_A, path_key(base_A))]
+
+    def feed(self, text: str):
+        current_A = self.current_A
+
+        # A single regex pass picks out the lines of interest; everything else in the log is
+        # skipped over without being sliced out or examined in Python.
+        # Each alternative ends in a different named group (or none at all, for the mismatch line), so
+        # lastgroup says which marker matched without probing the groups one at a time.
+        for match in _COMPARE_MARKERS.finditer(text):
+            kind = match.lastgroup
+            if kind == "root":
+                root_A = Path(match["root"])
+                current_A = [(0, root_A, path_key(root_A))]
+            elif kind == "path":
+                # Moving up the stack slices it rather than popping, so previous_A still
+                # holds the stack as it was should the diagnostics below be needed.
+                previous_A = current_A
+                new_A = match["path"].strip()
+                new_indent = len(match["indent"])
+                try:
+                    hypothetical_A = current_A[-1][1] / new_A
+                    if new_indent != current_A[-1][0] or path_key(hypothetical_A) != current_A[-1][2]:
+                        while new_indent <= current_A[-1][0]:
+                            current_A = current_A[:-1]
+                        next_A = current_A[-1][1] / new_A
+                        current_A.append((new_indent, next_A, path_key(next_A)))
+                except Exception as ex:
+                    # Only spend the effort on describing the state once something has gone wrong.
+                    raise RuntimeError(
+                        f"With line:\n{match.group(0)}\nA substring: {match['indent']}{match['path']}\nbase_A: {self.base_A}\n"
+                        f"new_indent = {new_indent}\ncurrent_A before = {previous_A}\ncurrent_A now = {current_A}\n"
+                        + str(ex)
+                    ) from ex
+            elif kind == "side":
+                (self.missing_A if match["side"] == "A" else self.missing_B).append(match["absent"])
+            else:
+                self.file_mismatches.append(str(current_A[-1][1].relative_to(self.base_A)))
+
+        self.current_A = current_A
+
+    def results(self):
+        return self.file_mismatches, self.missing_A, self.missing_B
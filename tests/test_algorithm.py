@@ -0,0 +1,48 @@
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import pytest
+
+from t_helpers import main_with_log
+from tree_inventory.actions.helpers import ALGORITHMS
+
+logger = logging.getLogger(__name__)
+
+
+def test_algorithm(cloned_trees: Tuple[Path, Path]):
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    # B is recalculated from scratch with another algorithm, so it can no longer be compared with A.
+    main_with_log(["--calculate", str(temp_path_B), "--new", "--algorithm", "sha256"] + addn_options)
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options, raise_on_error=False)
+    assert "cannot be compared" in test
+
+    # An existing record keeps its algorithm unless --new is given.
+    test = main_with_log(["--calculate", str(temp_path_A), "--algorithm", "sha256"], raise_on_error=False)
+    assert "Use --new" in test
+
+    main_with_log(["--calculate", str(temp_path_A), "--new", "--algorithm", "sha256"] + addn_options)
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+
+@pytest.mark.parametrize("algorithm", ["blake3", "xxh3_128"])
+def test_optional_algorithm(cloned_trees: Tuple[Path, Path], algorithm: str):
+    if algorithm not in ALGORITHMS:
+        pytest.skip(f"The optional package for {algorithm} is not installed.")
+
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    main_with_log(["--calculate", str(temp_path_A), "--new", "--algorithm", algorithm] + addn_options)
+    main_with_log(["--calculate", str(temp_path_B), "--new", "--algorithm", algorithm] + addn_options)
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-s"])
@@ -1,8 +1,9 @@
+import hashlib
 import logging
 
 import numpy as np
 
-# from tree_inventory.actions.helpers import calculate_md5
+from tree_inventory.actions.helpers import calculate_md5
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,9 @@ class SpecialTestFile:
         self.file_size = int(file_size_GiB * MiB)
         self.value_changes_at = (np.asarray(value_changes_at) * MiB).astype(int)
         self.fails_at = (np.asarray(fails_at) * MiB).astype(int)
+        # From value_changes_at[ii] onward, every byte is raised by a further ii.  So after passing
+        # n of the changes, the total raise is 0 + 1 + ... + (n-1), which is total_raise[n].
+        self.total_raise = np.concatenate(([0], np.cumsum(np.arange(len(self.value_changes_at)))))
 
     def __enter__(self):
         return self
@@ -42,25 +46,19 @@ class SpecialTestFile:
                 raise OSError(22, "Invalid argument")
 
         endpoint_exclusive = min(self.position + max_amount, self.file_size)
-        data = np.arange(self.position, endpoint_exclusive, dtype=int)
-        for ii in range(len(self.value_changes_at)):
-            value_change_at = self.value_changes_at[ii]
-            rel_value_change_at = value_change_at - self.position
-            if rel_value_change_at < endpoint_exclusive:
-                data[rel_value_change_at:] += ii
+        positions = np.arange(self.position, endpoint_exclusive, dtype=np.int64)
+        n_changes = np.searchsorted(self.value_changes_at, positions, side="right")
+        data = ((positions + self.total_raise[n_changes]) & 0xFF).astype(np.uint8)
         # if self.position >= endpoint_exclusive:
         # print(f"At EOF:\n\tposition = {self.position}\n\tendpoint_exclusive = {endpoint_exclusive}\n\tlen(data) = {len(data)}")
         self.position += len(data)
-        data = (data % 256).astype(np.uint8)
         logger.info(f"\tReturning {len(data)}-byte block...")
         return data.tobytes()
 
 
 def test_retry():
-    """
-    This is no longer relevant because I've replaced the MD5 calculation with a call
-    to certutil.
-
+    """The file appears to disconnect twice while it is read, and the checksum must
+    come out the same as for a read without any disconnection."""
     value_changes = [0.3, 0.9, 1.2, 1.8]
     breaks = [1.2, 3.4]
 
@@ -73,15 +71,20 @@ def test_retry():
         nonlocal file_with_breaks
         return file_with_breaks
 
+    # The file's contents depend only on position, so they can be read in one go for reference.
+    whole_file = SpecialTestFile(7.13, value_changes, [])
+    expected = hashlib.md5(whole_file.read(whole_file.file_size)).hexdigest()
+
     logger.info(f"Calculating checksum for normal case...")
     csum_normal = calculate_md5("Irrelevant", "Irrelevant", n_retries=5, _open_fcn=open_normal)
     logger.info(f"Checksum: {csum_normal.hexdigest()}\n")
     logger.info(f"Calculating checksum for disconnecting case...")
     csum_breaks = calculate_md5("Irrelevant", "Irrelevant", n_retries=5, _open_fcn=open_breaks)
     logger.info(f"Checksum: {csum_breaks.hexdigest()}\n")
-    assert csum_normal.hexdigest() == csum_breaks.hexdigest()
+    assert csum_normal.hexdigest() == expected
+    assert csum_breaks.hexdigest() == expected
+    assert file_with_breaks.n_fails_so_far == len(breaks)
     logger.info(f"Success.")
-    """
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import logging
+import os
+from pathlib import Path
+from typing import Tuple
+
+import pytest
+
+from t_helpers import main_with_events, main_with_log, results_from_events, write_text_to_file
+
+logger = logging.getLogger(__name__)
+
+
+def test_trust_mtime(cloned_trees: Tuple[Path, Path]):
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    # Change a file in B without changing its size or modification time, which --trust-mtime
+    # cannot tell apart from an unchanged file.
+    changed_file = temp_path_B / "Folder_B" / "File_B1.txt"
+    previous = os.stat(changed_file)
+    write_text_to_file(changed_file, "X" * previous.st_size)
+    os.utime(changed_file, ns=(previous.st_atime_ns, previous.st_mtime_ns))
+
+    main_with_log(["--calculate", str(temp_path_B), "--trust-mtime"] + addn_options)
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+    # Without it, the file is read again and the change is found.
+    main_with_log(["--calculate", str(temp_path_B)] + addn_options)
+    test, events = main_with_events(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    file_mismatches, missing_A, missing_B = results_from_events(events)
+    assert file_mismatches == ["Folder_B"]
+    assert len(missing_A) == 0
+    assert len(missing_B) == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-s"])
@@ -1,62 +1,119 @@
 import logging
-import shutil
 from pathlib import Path
-from time import sleep
+from typing import Tuple
 
-from t_helpers import main_with_log, parse_results, write_text_to_file
+import pytest
+
+from t_helpers import main_with_log, main_with_log_parallel, main_with_parsed, write_text_to_file
 
 logger = logging.getLogger(__name__)
 
 
-def test_update():
+def test_update(cloned_trees: Tuple[Path, Path]):
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    ###
+    ### Test 'update mode' where we copy/overwrite/remove files as needed
+    ###
+
+    # Add a file and directory to A to be copied with the update
+    write_text_to_file(
+        temp_path_A / "Folder_B" / "New_Folder" / "update_file_1.txt",
+        "A file to be transferred.",
+    )
+
+    # Add a file and directory to B to be removed with the update
+    write_text_to_file(
+        temp_path_B / "Folder_C" / "Unwanted_Folder" / "update_file_2.txt",
+        "A file to be removed.",
+    )
+    main_with_log_parallel(
+        ["--calculate", str(temp_path_A)] + addn_options,
+        ["--calculate", str(temp_path_B)] + addn_options,
+    )
+
+    _, file_mismatches, missing_A, missing_B = main_with_parsed(
+        ["--compare", str(temp_path_A), str(temp_path_B)] + addn_options, temp_path_A, temp_path_B
+    )
+    assert len(file_mismatches) == 0
+    assert missing_A == ["Unwanted_Folder"]
+    assert missing_B == ["New_Folder"]
+
+    main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
+
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+
+def test_update_renamed_file(cloned_trees: Tuple[Path, Path]):
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    # Rename a file in A, which the update should also rename in B rather than copy.
+    (temp_path_A / "Folder_B" / "File_B1.txt").rename(temp_path_A / "Folder_B" / "File_B1_renamed.txt")
+    main_with_log_parallel(
+        ["--calculate", str(temp_path_A)] + addn_options,
+        ["--calculate", str(temp_path_B)] + addn_options,
+    )
+
+    test = main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "Renaming file" in test
+    assert not (temp_path_B / "Folder_B" / "File_B1.txt").exists()
+
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+
+def test_update_reverted_file(cloned_trees: Tuple[Path, Path]):
+    addn_options = ["--v", "--detail-files"]
+
+    temp_path_A, temp_path_B = cloned_trees
+
+    changed_file = Path("Folder_B") / "File_B1.txt"
+    original_text = (temp_path_A / changed_file).read_text()
+
+    # Change a file in A and update B from it, then change it back and update B again.  The
+    # second update must not trust a file listing in B's record from before the first.
+    write_text_to_file(temp_path_A / changed_file, "A changed version of the file.")
+    main_with_log_parallel(
+        ["--calculate", str(temp_path_A)] + addn_options,
+        ["--calculate", str(temp_path_B)] + addn_options,
+    )
+    main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert (temp_path_B / changed_file).read_text() == "A changed version of the file."
+
+    write_text_to_file(temp_path_A / changed_file, original_text)
+    main_with_log(["--calculate", str(temp_path_A)] + addn_options)
+    main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert (temp_path_B / changed_file).read_text() == original_text
+
+    test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "No differences" in test
+
+
+def test_update_edited_destination(cloned_trees: Tuple[Path, Path]):
     addn_options = ["--v", "--detail-files"]
 
-    this_dir = Path(__file__).parent
-    resources_path = this_dir / "resources"
-    temp_path_A = this_dir / "tempA"
-    temp_path_B = this_dir / "tempB"
-    if temp_path_A.exists():
-        shutil.rmtree(temp_path_A)
-    if temp_path_B.exists():
-        shutil.rmtree(temp_path_B)
-    try:
-        shutil.copytree(resources_path, temp_path_A)
-        shutil.copytree(resources_path, temp_path_B)
-        sleep(1)
-
-        ###
-        ### Test 'update mode' where we copy/overwrite/remove files as needed
-        ###
-
-        # Add a file and directory to A to be copied with the update
-        write_text_to_file(
-            temp_path_A / "Folder_B" / "New_Folder" / "update_file_1.txt",
-            "A file to be transferred.",
-        )
-        main_with_log(["--calculate", str(temp_path_A)] + addn_options)
-
-        # Add a file and directory to B to be removed with the update
-        write_text_to_file(
-            temp_path_B / "Folder_C" / "Unwanted_Folder" / "update_file_2.txt",
-            "A file to be removed.",
-        )
-        main_with_log(["--calculate", str(temp_path_B)] + addn_options)
-
-        test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
-        file_mismatches, missing_A, missing_B = parse_results(test, temp_path_A, temp_path_B)
-        assert len(file_mismatches) == 0
-        assert missing_A == ["Unwanted_Folder"]
-        assert missing_B == ["New_Folder"]
-
-        main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
-
-        test = main_with_log(["--compare", str(temp_path_A), str(temp_path_B)] + addn_options)
-        assert "No differences" in test
-
-    finally:
-        shutil.rmtree(temp_path_A)
-        shutil.rmtree(temp_path_B)
+    temp_path_A, temp_path_B = cloned_trees
+
+    # Rename a file in A, then change the file in B after B's record was calculated.  B's record
+    # no longer describes that file, so the update must copy the renamed file rather than rename it.
+    (temp_path_A / "Folder_B" / "File_B1.txt").rename(temp_path_A / "Folder_B" / "File_B1_renamed.txt")
+    main_with_log_parallel(
+        ["--calculate", str(temp_path_A)] + addn_options,
+        ["--calculate", str(temp_path_B)] + addn_options,
+    )
+    write_text_to_file(temp_path_B / "Folder_B" / "File_B1.txt", "Edited after the record was calculated.")
+
+    test = main_with_log(["--update", str(temp_path_A), str(temp_path_B)] + addn_options)
+    assert "Renaming file" not in test
+    renamed_text = (temp_path_A / "Folder_B" / "File_B1_renamed.txt").read_text()
+    assert (temp_path_B / "Folder_B" / "File_B1_renamed.txt").read_text() == renamed_text
+    assert not (temp_path_B / "Folder_B" / "File_B1.txt").exists()
 
 
 if __name__ == "__main__":
-    test_update()
+    pytest.main([__file__, "-s"])
@@ -1,5 +1,3 @@
-import hashlib
-import json
 import logging
 import multiprocessing
 import multiprocessing.pool
@@ -8,21 +6,63 @@ import threading
 from datetime import datetime
 from pathlib import Path
 from time import perf_counter, sleep
-from typing import Callable, Optional
+from typing import Any, Callable, Optional
 
 from tqdm import tqdm
 
 from .helpers import (
-    calculate_md5,
+    DEFAULT_ALGORITHM,
+    NEW_ROLLUP,
+    RECORD_FILE_EXCLUDE,
+    calculate_file_md5,
     enumerate_dir,
+    enumerate_dir_entries,
     extract_record,
     find_checksum_file,
     find_key_by_value,
+    hash_wrapper,
+    new_hash,
     read_checksum_file,
+    record_algorithm,
+    record_rollup,
+    write_checksum_file,
 )
 
 logger = logging.getLogger(__name__)
 
+# Passed as n_parallel to use a thread count suited to this machine.
+AUTO_PARALLEL = 0
+
+
+class _Branch:
+    """The state of a folder that Calculator.calculate_branch() has entered but not yet finished."""
+
+    def __init__(
+        self,
+        record: dict,
+        dir: Path,
+        level: int,
+        previous: Optional[dict],
+        parent: Optional["_Branch"] = None,
+        name: Optional[str] = None,
+    ):
+        self.record = record
+        self.dir = dir
+        self.level = level
+        self.previous = previous
+        self.parent = parent
+        self.name = name
+        self.entered = False
+        self.checksum: Any = None
+        # The os.DirEntry of each file, from the listing.
+        self.files: list = []
+        self.subdirectories: list = []
+        # Subdirectories to be calculated on this thread, and those started on the thread pool.
+        self.serial: list = []
+        self.pending: list = []
+        # What each subdirectory calculated during this walk contributes to the checksum.
+        self.rollups: dict = {}
+
 
 class Calculator:
     def __init__(
@@ -32,26 +72,78 @@ class Calculator:
         n_parallel: int = 1,
         verbose: bool = False,
         very_verbose: bool = False,
+        algorithm: str = DEFAULT_ALGORITHM,
+        rollup: str = NEW_ROLLUP,
+        trust_mtime: bool = False,
+        use_certutil: bool = False,
     ):
         self.on_occasion: Optional[Callable] = None
         self.continue_previous = continue_previous
         self.detail_files = detail_files
         self.total_files = 0
         self.files_done = 0
+        # The number of files and subdirectories in the whole tree, once count_tree() has finished.
+        self.counted_total: Optional[int] = None
         self.last_occasion = perf_counter()
         self.between_occasions = 10.0
         self.verbose = verbose
         self.very_verbose = very_verbose
+        self.algorithm = algorithm
+        # Whether checksums are folded into their parent's as raw digests or (in older records) as hex text.
+        self.raw_rollup = rollup == "digest"
+        # Whether a file whose size and modification time match its previous file listing keeps
+        # its previous checksum rather than being read again.
+        self.trust_mtime = trust_mtime
+        self.use_certutil = use_certutil
+        if n_parallel == AUTO_PARALLEL:
+            n_parallel = min(32, (os.cpu_count() or 1) * 4)
         self.thread_pool = multiprocessing.pool.ThreadPool(n_parallel) if n_parallel > 1 else None
+        # Files get a pool of their own.  A subdirectory running on thread_pool waits on its
+        # files, so if they shared a pool, the busy subdirectories could leave no thread free
+        # to hash the files they are waiting on.
+        self.file_pool = multiprocessing.pool.ThreadPool(n_parallel) if n_parallel > 1 else None
         self.n_parallel = n_parallel
         self.n_pending = 0
         self.lock = threading.Lock()
+        # Rather than every file checking the time, a timer sets occasion_due when the next
+        # occasion is due.
+        self.occasion_due = threading.Event()
+        self.timer: Optional[threading.Timer] = None
+        self._start_timer()
+        # The counters are updated from every thread, so are only touched under counts_lock.
+        self.counts_lock = threading.Lock()
+        # The thread running count_tree(), if start_count() was called, and the event that stops it.
+        self.count_thread: Optional[threading.Thread] = None
+        self.count_stop = threading.Event()
         if self.verbose:
             logger.debug(f"Using {n_parallel} threads in parallel.")
 
     def __del__(self):
-        if self.thread_pool is not None:
-            self.thread_pool = None
+        self.close()
+
+    def close(self):
+        """Stops the timer for occasions, any count of the tree still running and the
+        threads of the pools, once the Calculator is finished with."""
+        timer = getattr(self, "timer", None)
+        if timer is not None:
+            timer.cancel()
+            self.timer = None
+        count_thread = getattr(self, "count_thread", None)
+        if count_thread is not None:
+            self.count_stop.set()
+            count_thread.join()
+            self.count_thread = None
+        for pool_name in ("thread_pool", "file_pool"):
+            pool = getattr(self, pool_name, None)
+            if pool is not None:
+                pool.close()
+                pool.join()
+                setattr(self, pool_name, None)
+
+    def _start_timer(self):
+        self.timer = threading.Timer(self.between_occasions, self.occasion_due.set)
+        self.timer.daemon = True
+        self.timer.start()
 
     def _do_occasion(self):
         self.last_occasion = perf_counter()
@@ -62,25 +154,83 @@ class Calculator:
             self.between_occasions = 60.0
         else:
             self.between_occasions = elapsed * 25
+        if self.timer is not None:
+            self._start_timer()
 
-    def calculate_branch(self, record: dict, dir: Path, level: int):
-        if perf_counter() - self.last_occasion > self.between_occasions:
-            self._do_occasion()
+    def _check_occasion(self):
+        """Calls _do_occasion() if it is due.  Only one thread at a time saves the record,
+        and any other that finds it busy carries on rather than waiting."""
+        if self.occasion_due.is_set() and self.lock.acquire(blocking=False):
+            try:
+                if self.occasion_due.is_set():
+                    self.occasion_due.clear()
+                    self._do_occasion()
+            finally:
+                self.lock.release()
 
-        checksum = hashlib.md5()
-        files, subdirectories = enumerate_dir(dir)
-        self.total_files += len(files) + len(subdirectories)
+    def _rollup_hex(self, hexdigest: str) -> bytes:
+        return bytes.fromhex(hexdigest) if self.raw_rollup else hexdigest.encode("utf-8")
+
+    def _rollup_hash(self, hash) -> bytes:
+        return hash.digest() if self.raw_rollup else hash.hexdigest().encode("utf-8")
+
+    def calculate_branch(self, record: dict, dir: Path, level: int, previous: Optional[dict] = None) -> bytes:
+        """Calculates the record for dir, and returns the checksum as it is to be
+        folded into the checksum of its parent.  The record only holds the hex
+        text, so handing the digest back directly saves the parent from having
+        to convert it back again.
+
+        With trust_mtime, previous is the record from an earlier calculation of
+        dir (which may be record itself, with --continue), if there is one.
+
+        The tree is walked with an explicit stack rather than by recursion, so its
+        depth is not limited by Python's recursion limit.  Each folder is entered
+        before its subdirectories are calculated and finished after, in the same
+        order as a recursive walk would.  Subdirectories handed to the thread pool
+        are walked there by a calculate_branch() of their own."""
+        top = _Branch(record, dir, level, previous)
+        stack = [top]
+        while stack:
+            branch = stack[-1]
+            if not branch.entered:
+                self._enter_branch(branch)
+                # Reversed, so that the first subdirectory comes off the stack first.
+                stack.extend(reversed(branch.serial))
+            else:
+                stack.pop()
+                rollup = self._finish_branch(branch)
+                if branch.parent is not None:
+                    branch.parent.rollups[branch.name] = rollup
+                else:
+                    return rollup
+        raise RuntimeError("The walk of the tree finished without finishing its top folder.")
+
+    def _enter_branch(self, branch: "_Branch"):
+        """The first half of calculating a folder: enumerates it and sets up the records of
+        its subdirectories, starting them on the thread pool where possible.  The rest are
+        left in branch.serial for the caller to calculate before _finish_branch()."""
+        branch.entered = True
+        record = branch.record
+        self._check_occasion()
+
+        checksum = branch.checksum = new_hash(self.algorithm)
+        # Skip the file that we created ourselves, but only at the top-level.
+        branch.files, subdirectories = enumerate_dir_entries(
+            branch.dir, RECORD_FILE_EXCLUDE if branch.level == 0 else ()
+        )
+        branch.subdirectories = subdirectories
+        with self.counts_lock:
+            self.total_files += len(branch.files) + len(subdirectories)
 
         if self.verbose:
             logger.debug(f"Initial MD5 is: {checksum.hexdigest()}")
-        total_size = 0
-        pending = []
-        were_parallel = 0
         if len(subdirectories) > 0:
             if not self.continue_previous or "subdirectories" not in record:
                 record["subdirectories"] = {}
+            previous = branch.previous
+            # The names go into the checksum one after another, so they can go in with one update().
+            checksum.update("".join(subdirectories).encode("utf-8"))
             for name in subdirectories:
-                checksum.update(name.encode("utf-8"))
                 sub_record = (
                     {}
                     if (not (self.continue_previous) or name not in record["subdirectories"])
@@ -88,64 +238,100 @@ class Calculator:
                 )
                 record["subdirectories"][name] = sub_record
                 if "MD5" not in sub_record:
-                    args = (sub_record, dir / name, level + 1)
-                    if self.thread_pool is None or self.n_pending >= self.n_parallel:
-                        self.calculate_branch(*args)
+                    previous_sub = previous.get("subdirectories", {}).get(name) if previous is not None else None
+                    args = (sub_record, branch.dir / name, branch.level + 1, previous_sub)
+                    use_pool = False
+                    if self.thread_pool is not None:
+                        with self.counts_lock:
+                            use_pool = self.n_pending < self.n_parallel
+                            if use_pool:
+                                self.n_pending += 1
+                    if not use_pool:
+                        branch.serial.append(_Branch(*args, parent=branch, name=name))
                     else:
-                        self.n_pending += 1
-                        were_parallel += 1
-                        pending.append(self.thread_pool.apply_async(self.calculate_branch, args))
-            for async_pending in pending:
-                async_pending.get()
-                self.n_pending -= 1
-            for name in subdirectories:
+                        branch.pending.append((name, self.thread_pool.apply_async(self.calculate_branch, args)))
+
+    def _finish_branch(self, branch: "_Branch") -> bytes:
+        """The second half of calculating a folder, once all of its subdirectories have been
+        calculated: folds them in, hashes its files and completes its record."""
+        record = branch.record
+        previous = branch.previous
+        checksum = branch.checksum
+        files = branch.files
+        rollups = branch.rollups
+        total_size = 0
+        if len(branch.subdirectories) > 0:
+            for name, async_pending in branch.pending:
+                rollups[name] = async_pending.get()
+                with self.counts_lock:
+                    self.n_pending -= 1
+            sub_rollups = []
+            for name in branch.subdirectories:
                 sub_record = record["subdirectories"][name]
-                checksum.update(sub_record["MD5"].encode("utf-8"))
+                # Subdirectories carried over by --continue were not calculated here, so theirs
+                # has to come from the record.
+                rollup = rollups.get(name)
+                sub_rollups.append(rollup if rollup is not None else self._rollup_hex(sub_record["MD5"]))
                 total_size += sub_record["size"]
-                self.files_done += 1
-                if self.lock.acquire(blocking=False):
-                    try:
-                        if perf_counter() - self.last_occasion > self.between_occasions:
-                            self._do_occasion()
-                    finally:
-                        self.lock.release()
+                with self.counts_lock:
+                    self.files_done += 1
+                self._check_occasion()
+            checksum.update(b"".join(sub_rollups))
 
         if self.verbose:
-            if were_parallel > 0:
-                logger.debug(f"{were_parallel} subdirectories were analyzed in parallel.")
+            if len(branch.pending) > 0:
+                logger.debug(f"{len(branch.pending)} subdirectories were analyzed in parallel.")
             logger.debug(f"After subdirectories, MD5 is: {checksum.hexdigest()}")
-        fileMD5 = hashlib.md5()
+        fileMD5 = new_hash(self.algorithm)
         n_files = 0
         files_size = 0
+        # Take the previous listing before it is replaced, since with --continue they are the same record.
+        previous_listing = previous.get("file-listing", {}) if previous is not None else {}
         if self.detail_files:
             file_listing = record["file-listing"] = {}
-        for name in files:
-            if level == 0 and name == "tree_checksum.json":
-                # Skip the file that we created ourselves, but only at the top-level.
-                self.files_done += 1
-                continue
+
+        def hash_file(entry: os.DirEntry):
+            # A single stat gives both the size and, for the file listing, the modification time.
+            # entry.stat() is not used, since on Windows it comes from the directory listing, which
+            # NTFS only updates lazily for a file that is open or hard-linked.  --trust-mtime relies
+            # on the listing having the file's true size and time.
+            name = entry.name
+            stat = os.stat(entry.path)
+            listed = previous_listing.get(name)
+            if listed is not None and listed["size"] == stat.st_size and listed["last-modified-at"] == stat.st_mtime:
+                return name, stat, hash_wrapper(listed["MD5"])
+            # The entry's path is already joined as a string, so no Path is built for each file.
+            return name, stat, calculate_file_md5(entry.path, algorithm=self.algorithm, use_certutil=self.use_certutil)
+
+        # The files are hashed in parallel when there is a file_pool, but imap() still hands
+        # the results back in order since that order goes into MD5-files_only.
+        hashed_files = map(hash_file, files) if self.file_pool is None else self.file_pool.imap(hash_file, files)
+        # Decided once per folder, since the message costs an extra finalize of fileMD5 per file.
+        log_each_file = self.very_verbose and logger.isEnabledFor(logging.DEBUG)
+        # What goes into fileMD5 is gathered up and passed to update() in batches.
+        file_parts = []
+        for name, stat, this_md5 in hashed_files:
+            file_size = stat.st_size
             n_files += 1
-            file_size = os.path.getsize(dir / name)
-            this_md5 = calculate_md5(dir, name)
-            fileMD5.update(name.encode("utf-8"))
-            fileMD5.update(this_md5.hexdigest().encode("utf-8"))
-            if self.very_verbose:
+            file_parts.append(name.encode("utf-8"))
+            file_parts.append(self._rollup_hash(this_md5))
+            if log_each_file or len(file_parts) >= 4096:
+                fileMD5.update(b"".join(file_parts))
+                file_parts.clear()
+            if log_each_file:
                 logger.debug(f"After file '{name}', MD5-files_only is: {fileMD5.hexdigest()}")
             files_size += file_size
             if self.detail_files:
                 file_listing[name] = {
                     "MD5": this_md5.hexdigest(),
                     "size": file_size,
-                    "last-modified-at": os.path.getmtime(dir / name),
+                    "last-modified-at": stat.st_mtime,
                 }
-            self.files_done += 1
-            if self.lock.acquire(blocking=False):
-                try:
-                    if perf_counter() - self.last_occasion > self.between_occasions:
-                        self._do_occasion()
-                finally:
-                    self.lock.release()
-        checksum.update(fileMD5.hexdigest().encode("utf-8"))
+            with self.counts_lock:
+                self.files_done += 1
+            self._check_occasion()
+        fileMD5.update(b"".join(file_parts))
+        checksum.update(self._rollup_hash(fileMD5))
         if self.verbose:
             logger.debug(f"After files, MD5 is: {checksum.hexdigest()}")
         total_size += files_size
@@ -155,10 +341,35 @@ class Calculator:
         record["MD5-files_only"] = fileMD5.hexdigest()
 
         record["MD5"] = checksum.hexdigest()
-        return
+        return self._rollup_hash(checksum)
+
+    def start_count(self, dir: Path, level: int):
+        """Starts count_tree() on a thread of its own, which close() stops if it is still running."""
+        self.count_thread = threading.Thread(target=self.count_tree, args=(dir, level), daemon=True)
+        self.count_thread.start()
+
+    def count_tree(self, dir: Path, level: int):
+        """Counts the files and subdirectories within dir, as calculate_branch() will
+        count them but without reading any files, and stores it as counted_total.  The
+        count is abandoned if count_stop is set."""
+        n_entries = 0
+        stack = [(dir, level)]
+        try:
+            while stack:
+                if self.count_stop.is_set():
+                    return
+                dir, level = stack.pop()
+                files, subdirectories = enumerate_dir(dir, RECORD_FILE_EXCLUDE if level == 0 else ())
+                n_entries += len(files) + len(subdirectories)
+                stack.extend((dir / name, level + 1) for name in subdirectories)
+        except OSError as ex:
+            # The count is only for the progress bar.  calculate_branch() reports any real problem.
+            logger.debug(f"Could not count the files in the tree: {ex}")
+            return
+        self.counted_total = n_entries
 
     def recalculate(self, record: dict):
-        checksum = hashlib.md5()
+        checksum = new_hash(self.algorithm)
         for name in record["subdirectories"]:
             checksum.update(name.encode("utf-8"))
             sub_record = record["subdirectories"][name]
@@ -167,15 +378,15 @@ class Calculator:
                 raise RuntimeError(
                     f"Cannot recalculate this record because one or more sub-records does not have a completed checksum."
                 )
-            checksum.update(sub_record["MD5"].encode("utf-8"))
+            checksum.update(self._rollup_hex(sub_record["MD5"]))
         if "MD5-files_only" not in record and "MD5" not in record:
             # We might be recalculating a subdirectory even though the higher-level calculation was never completed.
             # In this case, just leave the higher-level entries incomplete and the user can use --continue to progress.
             return
         fileMD5_str = record["MD5-files_only"]
-        checksum.update(fileMD5_str.encode("utf-8"))
+        checksum.update(self._rollup_hex(fileMD5_str))
         record["MD5"] = checksum.hexdigest()
-        return
+        return self._rollup_hash(checksum)
 
 
 def calculate_tree(
@@ -185,10 +396,30 @@ def calculate_tree(
     detail_files: bool = False,
     n_parallel: int = 1,
     verbose: bool = False,
+    algorithm: Optional[str] = None,
+    trust_mtime: bool = False,
+    count_first: bool = False,
+    use_certutil: bool = False,
 ):
     """calculate_tree() implements the main record calculation facility
     of tree_inventory and is invoked via the --calculate command-line
     option.
+
+    The algorithm only applies to a new record file, and defaults to MD5.
+    An existing record file is always updated with the algorithm and rollup
+    that it was calculated with.
+
+    With trust_mtime, a file keeps the checksum from the existing record if
+    its size and modification time have not changed since, instead of being
+    read again.  This needs the file listings, so implies detail_files.
+
+    With count_first, the files in the tree are counted on another thread
+    while the calculation runs, so that the progress bar has a true total
+    once the count is done.  It does not apply with continue_previous, since
+    the parts already calculated are not counted as progress.
+
+    With use_certutil, files are hashed by Windows' certutil rather than read
+    here.  The checksums are the same either way.
     """
 
     if start_new and continue_previous:
@@ -198,6 +429,8 @@ def calculate_tree(
 
     root_record = None
     target_record = None
+    previous_record = None
+    rollup = NEW_ROLLUP
     parent_records = []
     if start_new:
         csum_record_file = target / "tree_checksum.json"
@@ -230,14 +463,28 @@ def calculate_tree(
         else:
             logger.info(f"Updating existing checksum file found at: {csum_record_file}")
             root_record = read_checksum_file(csum_record_file)
+            existing_algorithm = record_algorithm(root_record)
+            if algorithm is not None and algorithm != existing_algorithm:
+                raise RuntimeError(
+                    f"The checksum file at {csum_record_file} was calculated with {existing_algorithm}, not {algorithm}."
+                    + f"  Use --new to start a new record file with {algorithm}."
+                )
+            algorithm = existing_algorithm
+            rollup = record_rollup(root_record)
             _, parent_records = extract_record(root_record, csum_record_file, target)
             target_record = parent_records[-1]
             parent_records = parent_records[:-1]
+            # With --continue, the record is updated in place and so serves as its own previous record.
+            previous_record = target_record if continue_previous else dict(target_record)
             if not (continue_previous):
                 # target_record still needs to be referenced by its parent, but everything within
                 # it can be wiped out.  So can't create a new dictionary here, but can use clear().
                 target_record.clear()
                 target_record["calculated_at"] = datetime.now().isoformat()
+    if algorithm is None:
+        algorithm = DEFAULT_ALGORITHM
+    root_record["algorithm"] = algorithm
+    root_record["rollup"] = rollup
 
     # Mark all parent records as invalidated until we complete.
     # It's possible that the caller is re-doing a particular subdirectory even though the full
@@ -253,8 +500,17 @@ def calculate_tree(
     parent_records_str = "root / " + " / ".join(parent_records_subdir_names)
     logger.debug(f"parent records = {parent_records_str}")
 
-    calc = Calculator(continue_previous, detail_files, n_parallel=n_parallel, verbose=verbose)
-    with tqdm(total=1) as progress:
+    calc = Calculator(
+        continue_previous,
+        detail_files or trust_mtime,
+        n_parallel=n_parallel,
+        verbose=verbose,
+        algorithm=algorithm,
+        rollup=rollup,
+        trust_mtime=trust_mtime,
+        use_certutil=use_certutil,
+    )
+    with tqdm(total=1, mininterval=1.0) as progress:
         # calc.verbose = True
         # calc.very_verbose = True
 
@@ -267,20 +523,26 @@ def calculate_tree(
                 for ii in range(len(parent_records) - 1, -1, -1):
                     calc.recalculate(parent_records[ii])
 
-            with open(csum_record_file, "wt") as outfile:
-                json.dump(root_record, outfile, indent=4)
+            # Only the final record is indented for reading, since the checkpoints are only there to
+            # be continued from and the indentation makes them much larger and slower to write.
+            write_checksum_file(csum_record_file, root_record, pretty=final)
 
         def on_occasion():
             nonlocal progress, calc
 
-            progress.total = calc.total_files
-            progress.n = calc.files_done
-            progress.refresh()
+            total = calc.total_files
+            if calc.counted_total is not None:
+                total = max(total, calc.counted_total)
+            progress.total = total
+            progress.update(calc.files_done - progress.n)
 
             save_record(final=False)
 
         calc.on_occasion = on_occasion
-        calc.calculate_branch(target_record, target, len(parent_records))
+        if count_first and not continue_previous:
+            calc.start_count(target, len(parent_records))
+        calc.calculate_branch(target_record, target, len(parent_records), previous_record if trust_mtime else None)
+    calc.close()
     save_record(final=True)
     del calc
     logger.info(f"Done.")
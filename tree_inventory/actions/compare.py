@@ -1,16 +1,29 @@
+import json
 import logging
+import multiprocessing.pool
 import os
+from functools import partial
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
-from .helpers import extract_record, find_checksum_file, read_checksum_file
+from .helpers import extract_record, find_checksum_file, read_checksum_file, record_hashing
 
 logger = logging.getLogger(__name__)
 
 PathOrStr = Union[Path, str]
 
+# Stands in for a record's missing "subdirectories" without making a new dict each time.  Never modified.
+_EMPTY: dict = {}
 
-def compare_trees(A: Path, B: Path, depth: int = 2):
+
+def _child_path(base: str, name: str) -> str:
+    """Gives str(Path(base) / name) without building the Path."""
+    if base == ".":
+        return name
+    return base + name if base.endswith(os.sep) else base + os.sep + name
+
+
+def compare_trees(A: Path, B: Path, depth: int = 2, events_file: Optional[Path] = None):
     """compare_trees() implements the main record comparison facility
     of tree_inventory and is invoked via the --compare command-line
     option.  It relies entirely on the records for comparison, so
@@ -20,19 +33,41 @@ def compare_trees(A: Path, B: Path, depth: int = 2):
     with only enough detail to home in on the areas of interest.  The
     compare_trees() function is basically a "diff" operation, but based
     on the checksum record files.
+
+    If events_file is given, each difference is also written to it as one
+    JSON object per line, for consumption by other programs.  Every event
+    has an "event" key and a "path" key giving the folder relative to A
+    (or B), and is one of:
+        no-checksum:    {"tree": "A" or "B"} - the folder has no checksum yet.
+        files-mismatch: the files directly within the folder differ.
+        absent:         {"absent_from": "A" or "B", "name": ...} - a subdirectory is missing.
+        differs:        a subdirectory beyond --depth contains differences.
+        unexplained:    the checksums differ but no specific difference was found.
     """
 
     logger.info(f"Comparing trees:\n\tA: {A}\n\tB: {B}")
-    A_record_file = find_checksum_file(A)
-    if A_record_file is None:
-        raise RuntimeError(f"No checksum file was found for path '{A}'.  Use --calculate first.")
-    B_record_file = find_checksum_file(B)
-    if B_record_file is None:
-        raise RuntimeError(f"No checksum file was found for path '{B}'.  Use --calculate first.")
+
+    # A and B are often on different drives, or across a network, so look for and read both at once.
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        A_record_file, B_record_file = pool.map(find_checksum_file, [A, B])
+        if A_record_file is None:
+            raise RuntimeError(f"No checksum file was found for path '{A}'.  Use --calculate first.")
+        if B_record_file is None:
+            raise RuntimeError(f"No checksum file was found for path '{B}'.  Use --calculate first.")
+        if os.path.samefile(A_record_file, B_record_file):
+            # A and B are within the same tree, so its record file is only read once.
+            A_record = B_record = read_checksum_file(A_record_file)
+        else:
+            A_record, B_record = pool.map(read_checksum_file, [A_record_file, B_record_file])
     logger.debug(f"Checksum file A found at: {A_record_file}")
     logger.debug(f"Checksum file B found at: {B_record_file}")
-    A_record = read_checksum_file(A_record_file)
-    B_record = read_checksum_file(B_record_file)
+    A_hashing = record_hashing(A_record)
+    B_hashing = record_hashing(B_record)
+    if A_hashing != B_hashing:
+        raise RuntimeError(
+            f"The checksums for A were calculated with {A_hashing} but those for B with {B_hashing}, so they"
+            + f" cannot be compared.  Recalculate one of them with --new."
+        )
     A_rel_path, A_records = extract_record(A_record, A_record_file, A)
     B_rel_path, B_records = extract_record(B_record, B_record_file, B)
     A_subrecord = A_records[-1]
@@ -51,87 +86,174 @@ def compare_trees(A: Path, B: Path, depth: int = 2):
     except:
         terminal_width = 100
 
-    def compare_branch(A_base_path: Path, B_base_path: Path, A_record: dict, B_record: dict, level: int):
-        """compare_branch() is the recursive workhorse of compare_trees() that operates on a particular
-        folder within the trees.
+    events: Optional[list] = [] if events_file is not None else None
+
+    def emit(event: str, rel_path: str, **fields):
+        if events is not None:
+            events.append({"event": event, "path": rel_path, **fields})
+
+    def compare_branch(
+        A_base_path: str,
+        B_base_path: str,
+        A_record: dict,
+        B_record: dict,
+        level: int,
+        msg: list,
+        rel_path: str = ".",
+    ):
+        """compare_branch() is the workhorse of compare_trees() that operates on a particular
+        folder within the trees and those beneath it.  The text describing any differences is
+        appended to msg, which is shared by the whole comparison so that the result can be
+        joined together once at the end.
+
+        The folders are walked with an explicit stack rather than by recursion.  Each entry is
+        either the arguments for enter_branch() or a step left over from a folder entered
+        earlier, to be taken once the subdirectories ahead of it have been compared.  They are
+        pushed in reverse so the output comes out in the same order as a recursive walk's.
+
+        The paths are kept as the strings that str() of their Path would give, since they
+        are only ever needed for the text and events.
+        """
+
+        stack: list = [(A_base_path, B_base_path, A_record, B_record, level, rel_path)]
+        while stack:
+            item = stack.pop()
+            if callable(item):
+                item()
+            else:
+                stack.extend(reversed(enter_branch(*item, msg)))
+
+    def enter_branch(
+        A_base_path: str,
+        B_base_path: str,
+        A_record: dict,
+        B_record: dict,
+        level: int,
+        rel_path: str,
+        msg: list,
+    ) -> list:
+        """Compares one folder, and returns the steps still to be taken for it in order: the
+        arguments for enter_branch() on each subdirectory that differs, and the steps that
+        report on it once those are done.
 
-        Note: if changing the aesthetics here (the text written to msg), also check that test_general.py's
-        parse_results() function is updated to be able to parse the new output.
+        Note: if changing the aesthetics here (the text written to msg), also check that t_helpers.py's
+        CompareOutputParser is updated to be able to parse the new output.
         """
 
         # tab = "o"      # For debugging.
         tab = "\t"
+        indent = tab * level
 
-        A_name = str(A_base_path) + " (A)"
-        B_name = str(B_base_path) + " (B)"
+        A_name = A_base_path + " (A)"
+        B_name = B_base_path + " (B)"
         if level > 0 and len(A_name) + len(B_name) > (terminal_width - 55):
-            A_name = A_base_path.name + " (A)"
-            B_name = B_base_path.name + " (B)"
-
-        if "MD5" not in A_record:
-            return (
-                tab * (level)
-            ) + f"{A_name} does not have a checksum.  Run --calculate first (perhaps with --continue).\n"
-        if "MD5" not in B_record:
-            return (
-                tab * (level)
-            ) + f"{B_name} does not have a checksum.  Run --calculate first (perhaps with --continue).\n"
-
-        if A_record["MD5"] == B_record["MD5"] and A_record["n_files"] == B_record["n_files"]:
-            return ""
-
-        msg = ""
+            # Below the top, the paths always end in a name after a separator.
+            A_name = A_base_path[A_base_path.rfind(os.sep) + 1 :] + " (A)"
+            B_name = B_base_path[B_base_path.rfind(os.sep) + 1 :] + " (B)"
+
+        A_md5 = A_record.get("MD5")
+        B_md5 = B_record.get("MD5")
+        if A_md5 is None:
+            emit("no-checksum", rel_path, tree="A")
+            msg.append(
+                indent + f"{A_name} does not have a checksum.  Run --calculate first (perhaps with --continue).\n"
+            )
+            return []
+        if B_md5 is None:
+            emit("no-checksum", rel_path, tree="B")
+            msg.append(
+                indent + f"{B_name} does not have a checksum.  Run --calculate first (perhaps with --continue).\n"
+            )
+            return []
+
+        if A_md5 == B_md5 and A_record["n_files"] == B_record["n_files"]:
+            return []
+
+        item_indent = indent + tab
+        msg.append(indent + f"{A_name} vs {B_name}:\n")
+        n_before = len(msg)
         if A_record["MD5-files_only"] != B_record["MD5-files_only"]:
-            msg += (tab * (level + 1)) + f"Files within this folder mismatch.\n"
+            msg.append(item_indent + f"Files within this folder mismatch.\n")
+            emit("files-mismatch", rel_path)
 
         # Check if any subdirectories are absent first
 
-        A_subdirectories = A_record["subdirectories"] if "subdirectories" in A_record else {}
-        B_subdirectories = B_record["subdirectories"] if "subdirectories" in B_record else {}
+        A_subdirectories = A_record.get("subdirectories", _EMPTY)
+        B_subdirectories = B_record.get("subdirectories", _EMPTY)
+        # Split the names once into those in only one tree and those in both.  The lists keep the
+        # records' (sorted) order, so the output comes out in the same order every time.
+        in_both = []
         for name in A_subdirectories:
-            a_record = A_subdirectories[name]
-            if name not in B_subdirectories:
-                msg += (tab * (level + 1)) + f"Directory '{name}' absent from B.\n"
-        for name in B_subdirectories:
-            b_record = B_subdirectories[name]
-            if name not in A_subdirectories:
-                msg += (tab * (level + 1)) + f"Directory '{name}' absent from A.\n"
+            if name in B_subdirectories:
+                in_both.append(name)
+            else:
+                msg.append(item_indent + f"Directory '{name}' absent from B.\n")
+                emit("absent", rel_path, name=name, absent_from="B")
+        if len(in_both) < len(B_subdirectories):
+            for name in B_subdirectories:
+                if name not in A_subdirectories:
+                    msg.append(item_indent + f"Directory '{name}' absent from A.\n")
+                    emit("absent", rel_path, name=name, absent_from="A")
+
+        def report_differs(name: str):
+            msg.append(item_indent + f"Directory '{name}' contains differences between A and B.\n")
+            emit("differs", _child_path(rel_path, name))
 
-        for name in set(A_subdirectories.keys()).intersection(B_subdirectories.keys()):
+        def finish():
+            if len(msg) == n_before:
+                # I'm not sure if this is an error condition or if there is a legitimate case where this
+                # can come up.  For now, I'm displaying a bunch of diagnostic info as if it were an error.
+                emit("unexplained", rel_path)
+                msg.append(
+                    item_indent
+                    + f"The MD5 mismatches but no specific difference was found."
+                    + f"\nSubdirectories in A:\n{A_subdirectories}"
+                    + f"\nSubdirectories in B:\n{B_subdirectories}"
+                    + f"\nSubdirectories in both:\n{set(in_both)}"
+                    + f"\nA record:\n{A_record}"
+                    + f"\nB record:\n{B_record}"
+                    + "\n"
+                )
+
+            # msg.append(f"Considered: {A_base_path} (A {A_record['MD5']}) vs {B_base_path} (B {B_record['MD5']})\n")
+
+        steps: list = []
+        for name in in_both:
             a_record = A_subdirectories[name]
             b_record = B_subdirectories[name]
+            # Most subdirectories match, so skip the step for those.
+            a_md5 = a_record.get("MD5")
+            if a_md5 is not None and a_md5 == b_record.get("MD5") and a_record["n_files"] == b_record["n_files"]:
+                continue
             if level + 1 < depth:
-                msg += compare_branch(
-                    A_base_path / name,
-                    B_base_path / name,
-                    a_record,
-                    b_record,
-                    level + 1,
+                steps.append(
+                    (
+                        _child_path(A_base_path, name),
+                        _child_path(B_base_path, name),
+                        a_record,
+                        b_record,
+                        level + 1,
+                        _child_path(rel_path, name),
+                    )
                 )
             else:
                 if a_record["MD5"] != b_record["MD5"]:
-                    msg += (tab * (level + 1)) + f"Directory '{name}' contains differences between A and B.\n"
-
-        if not msg:
-            # I'm not sure if this is an error condition or if there is a legitimate case where this
-            # can come up.  For now, I'm displaying a bunch of diagnostic info as if it were an error.
-            msg = (tab * (level + 1)) + f"The MD5 mismatches but no specific difference was found."
-            msg += f"\nSubdirectories in A:\n{A_subdirectories}"
-            msg += f"\nSubdirectories in B:\n{B_subdirectories}"
-            msg += f"\nSubdirectories in both:\n{set(A_subdirectories.keys()).intersection(B_subdirectories.keys())}"
-            msg += f"\nA record:\n{A_record}"
-            msg += f"\nB record:\n{B_record}"
-            msg += "\n"
-        msg = (tab * (level)) + f"{A_name} vs {B_name}:\n" + msg
-
-        # msg += f"Considered: {A_base_path} (A {A_record['MD5']}) vs {B_base_path} (B {B_record['MD5']})\n"
-
-        return msg
+                    steps.append(partial(report_differs, name))
+        steps.append(finish)
+        return steps
 
     A_base_path = A_record_file.parent / A_rel_path
     B_base_path = B_record_file.parent / B_rel_path
-    result = compare_branch(A_base_path, B_base_path, A_subrecord, B_subrecord, level=0)
-    if not (result):
-        result = "\tNo differences found.\n"
-    result = f"\n\nAs of {A_record['calculated_at']} (A) and {B_record['calculated_at']} (B):\n" + result
-    logger.info(result)
+    msg: list = [f"\n\nAs of {A_record['calculated_at']} (A) and {B_record['calculated_at']} (B):\n"]
+    # Unchanged trees are the common case, and the top checksums alone settle it.
+    A_md5 = A_subrecord.get("MD5")
+    if A_md5 is None or A_md5 != B_subrecord.get("MD5") or A_subrecord["n_files"] != B_subrecord["n_files"]:
+        compare_branch(str(A_base_path), str(B_base_path), A_subrecord, B_subrecord, 0, msg)
+    if len(msg) == 1:
+        msg.append("\tNo differences found.\n")
+    logger.info("".join(msg))
+
+    if events is not None:
+        with open(events_file, "wt") as fh:
+            for event in events:
+                fh.write(json.dumps(event) + "\n")
@@ -1,6 +1,7 @@
 # TODO: no unit tests on find_duplicates.
 
 import logging
+import os
 from pathlib import Path
 from typing import Union
 
@@ -10,6 +11,9 @@ logger = logging.getLogger(__name__)
 
 PathOrStr = Union[Path, str]
 
+# Stands in for a record's missing "subdirectories" without making a new dict each time.  Never modified.
+_EMPTY: dict = {}
+
 
 def find_duplicates(A: Path, count: int = -1):
     """find_duplicates() searches for duplication within an
@@ -39,54 +43,62 @@ def find_duplicates(A: Path, count: int = -1):
     duplicates: list = []
     hashtable: dict = {}
 
+    # The relative paths of each pair in duplicates, both ways round, so that is_already_duplicate()
+    # can look its ancestors up rather than checking against every duplicate found so far.
+    reported_pairs: set = set()
+
     def is_already_duplicate(old_entry, new_entry):
         # Detect if this duplication is already listed as part of a higher-level
         # directory in the tree.
-        nonlocal duplicates
-
-        new_record_A, new_rel_path_A = old_entry
-        new_record_B, new_rel_path_B = new_entry
-
-        for entry in duplicates:
-            size, dupe_A, dupe_B = entry
-            existing_record_A, existing_rel_path_A = dupe_A
-            existing_record_B, existing_rel_path_B = dupe_B
-            if (
-                new_rel_path_A.is_relative_to(existing_rel_path_A)
-                and new_rel_path_B.is_relative_to(existing_rel_path_B)
-            ) or (
-                new_rel_path_B.is_relative_to(existing_rel_path_A)
-                and new_rel_path_A.is_relative_to(existing_rel_path_B)
-            ):
-                return True
+        nonlocal reported_pairs
+
+        new_rel_path_A = Path(old_entry[1])
+        new_rel_path_B = Path(new_entry[1])
+
+        ancestors_B = [str(path) for path in (new_rel_path_B, *new_rel_path_B.parents)]
+        for path in (new_rel_path_A, *new_rel_path_A.parents):
+            ancestor_A = str(path)
+            for ancestor_B in ancestors_B:
+                if (ancestor_A, ancestor_B) in reported_pairs:
+                    return True
         return False
 
-    def collect_checksums(rel_path: str, record: dict, is_within_duplicates: bool = False):
-        nonlocal duplicates, hashtable
-
-        new_size = record["size"]
-        if new_size < 1:
-            return
-
-        checksum = record["MD5"]
-        new_entry = (record, rel_path)
-        if checksum in hashtable:
-            if not is_within_duplicates:
-                for old_entry in hashtable[checksum]:
-                    old_record, old_rel_path = old_entry
-                    if old_record["size"] == new_size:
-                        if not is_already_duplicate(old_entry, new_entry):
-                            duplicates.append((new_size, old_entry, new_entry))
-                        is_within_duplicates = True
-                        break
-            hashtable[checksum].append(new_entry)
-        else:
-            hashtable[checksum] = [new_entry]
-
-        subdirectories = record["subdirectories"] if "subdirectories" in record else {}
-        for name in subdirectories:
-            rel_sub_path = Path(rel_path) / name
-            collect_checksums(rel_sub_path, subdirectories[name], is_within_duplicates)
+    def collect_checksums(rel_path: Path, record: dict):
+        """Walks the records with an explicit stack, in the same order as a recursive walk would.
+        The relative paths are built up as plain strings, the same as str() of the Path would
+        give, since most of them are never needed as a Path."""
+        nonlocal duplicates, reported_pairs, hashtable
+
+        stack = [(str(rel_path), record, False)]
+        while stack:
+            rel_path, record, is_within_duplicates = stack.pop()
+            new_size = record["size"]
+            if new_size < 1:
+                continue
+
+            checksum = record["MD5"]
+            new_entry = (record, rel_path)
+            if checksum in hashtable:
+                if not is_within_duplicates:
+                    for old_entry in hashtable[checksum]:
+                        old_record, old_rel_path = old_entry
+                        if old_record["size"] == new_size:
+                            if not is_already_duplicate(old_entry, new_entry):
+                                duplicates.append((new_size, old_entry, new_entry))
+                                reported_pairs.add((old_rel_path, rel_path))
+                                reported_pairs.add((rel_path, old_rel_path))
+                            is_within_duplicates = True
+                            break
+                hashtable[checksum].append(new_entry)
+            else:
+                hashtable[checksum] = [new_entry]
+
+            subdirectories = record.get("subdirectories", _EMPTY)
+            prefix = "" if rel_path == "." else rel_path + os.sep
+            # Reversed, so that the first subdirectory comes off the stack first.
+            stack.extend(
+                (prefix + name, subdirectories[name], is_within_duplicates) for name in reversed(subdirectories)
+            )
 
     logger.info(f"Looking for duplicates in: {root_path / A_rel_path}")
     collect_checksums(A_rel_path, A_subrecord)
@@ -95,13 +107,11 @@ def find_duplicates(A: Path, count: int = -1):
     # Sort duplicates by size
     duplicates.sort(reverse=True, key=lambda x: x[0])
 
-    # Save results in duplicates.csv.
+    # Save results in duplicates.csv, written all at once.
+    lines = ['"Size (in bytes)","Folder Path","Duplicate Folder Path",\n']
+    for size, (record1, rel_path1), (record2, rel_path2) in duplicates:
+        lines.append(f'"{size}","{rel_path1}","{rel_path2}",\n')
     with open("duplicates.csv", "wt") as fh:
-        fh.write('"Size (in bytes)","Folder Path","Duplicate Folder Path",\n')
-        for dupe in duplicates:
-            size = dupe[0]
-            record1, rel_path1 = dupe[1]
-            record2, rel_path2 = dupe[2]
-            fh.write(f'"{size}","{rel_path1}","{rel_path2}",\n')
+        fh.write("".join(lines))
 
     logger.info(f"Duplicates list saved to duplicates.csv.")
@@ -3,13 +3,31 @@ from __future__ import annotations
 import hashlib
 import json
 import logging
+import mmap
 import os
 import subprocess
+import threading
 from pathlib import Path
 from time import sleep
-from typing import Any, Optional, Tuple, Union
-
-from . import symlinks
+from typing import Any, Collection, Optional, Tuple, Union
+
+try:
+    # orjson is optional, but reads and writes large record files several times faster.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # blake3 is optional, and adds an algorithm several times faster than those in hashlib.
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    # xxhash is optional, and adds xxh3_128, a non-cryptographic hash that is faster still.
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +41,69 @@ def find_key_by_value(dictionary: dict, value):
 
 AUTO = None
 
+# The hash algorithms that a record can be calculated with.  Records written before the
+# choice existed have no "algorithm" entry and were calculated with MD5.  The record keys
+# are still named "MD5" and "MD5-files_only" whichever algorithm is in use.
+# blake3 and xxh3_128 are only offered when their packages are installed.  certutil cannot
+# calculate them, so files are always read by calculate_md5_internal() for them, even with
+# use_certutil.
+CERTUTIL_ALGORITHMS = ("md5", "sha256")
+ALGORITHMS = (
+    CERTUTIL_ALGORITHMS + (("blake3",) if blake3 is not None else ()) + (("xxh3_128",) if xxhash is not None else ())
+)
+DEFAULT_ALGORITHM = "md5"
+
+
+# Files at least this large are hashed by blake3 on several threads of its own.
+BLAKE3_THREADED_SIZE = 16 << 20
+
+
+def new_hash(algorithm: str = DEFAULT_ALGORITHM, size: int = 0) -> Any:
+    """Starts a new hash object for one of the ALGORITHMS.  size is that of the
+    file to be hashed, if known."""
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise RuntimeError(f"The blake3 algorithm requires the blake3 package, which is not installed.")
+        if size >= BLAKE3_THREADED_SIZE:
+            return blake3.blake3(max_threads=blake3.blake3.AUTO)
+        return blake3.blake3()
+    if algorithm == "xxh3_128":
+        if xxhash is None:
+            raise RuntimeError(f"The xxh3_128 algorithm requires the xxhash package, which is not installed.")
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+
+# How each file and subdirectory checksum is folded into the checksum of the folder that
+# contains it: as its "hex" text, which is how records written before the choice existed
+# were calculated, or as the raw "digest" bytes, which is how new records are calculated.
+NEW_ROLLUP = "digest"
+
+
+def record_algorithm(root_record: dict) -> str:
+    """The hash algorithm that a record file was calculated with."""
+    return root_record.get("algorithm", DEFAULT_ALGORITHM)
+
 
-def calculate_md5_internal(pathname: Path, n_retries: Optional[int] = AUTO, _open_fcn=open) -> Any:
-    block_size = 1 << 20  # Up to 1MB per chunk
-    hash_md5 = hashlib.md5()
+def record_rollup(root_record: dict) -> str:
+    """The rollup that a record file was calculated with."""
+    return root_record.get("rollup", "hex")
+
+
+def record_hashing(root_record: dict) -> str:
+    """Describes how a record file was calculated.  Checksums from two
+    record files can only be compared if this matches."""
+    return f"{record_algorithm(root_record)} with a {record_rollup(root_record)} rollup"
+
+
+READ_BLOCK_SIZE = 1 << 20  # Up to 1MB per chunk
+
+
+def calculate_md5_internal(
+    pathname: Path, n_retries: Optional[int] = AUTO, _open_fcn=open, algorithm: str = DEFAULT_ALGORITHM
+) -> Any:
+    block_size = READ_BLOCK_SIZE
+    hash_md5 = None
     # hash_md5.update(str(fname).encode("utf-8"))
     position = 0
     size = None
@@ -34,22 +111,38 @@ def calculate_md5_internal(pathname: Path, n_retries: Optional[int] = AUTO, _ope
     retries = 1
     while True:
         try:
-            with _open_fcn(pathname, "rb") as f:
+            # For a real file, skip Python's read buffer since every read is a large block anyway.
+            with (_open_fcn(pathname, "rb", buffering=0) if _open_fcn is open else _open_fcn(pathname, "rb")) as f:
                 if size is None:
                     f.seek(0, 2)
                     size = f.tell()
                     if n_retries is None:
                         n_retries = 1 + (size // (1 << 30))  # Allow 1 retry plus 1 retry per GB
                     retries = n_retries
+                if hash_md5 is None:
+                    hash_md5 = new_hash(algorithm, size)
                 f.seek(position, 0)
-                while True:
-                    chunk = f.read(block_size)
-                    if chunk == b"":
-                        if retry > 0:
-                            logger.info(f"Retry successful, completed checksum for: {pathname}")
-                        return hash_md5
-                    position += len(chunk)
-                    hash_md5.update(chunk)
+                if hasattr(f, "readinto"):
+                    # Read each block into the same buffer rather than allocating a new bytes
+                    # object per block, as hashlib.file_digest() does.  update() releases the GIL
+                    # for blocks of this size.  Each thread keeps its buffer from file to file.
+                    view = _read_buffer()[:block_size]
+                    while True:
+                        n_read = f.readinto(view)
+                        if not n_read:
+                            break
+                        position += n_read
+                        hash_md5.update(view[:n_read])
+                else:
+                    while True:
+                        chunk = f.read(block_size)
+                        if chunk == b"":
+                            break
+                        position += len(chunk)
+                        hash_md5.update(chunk)
+                if retry > 0:
+                    logger.info(f"Retry successful, completed checksum for: {pathname}")
+                return hash_md5
                 # for chunk in iter(lambda: f.read(4096), b""):
                 # hash_md5.update(chunk)
             # print(f"MD5 of file '{fname}': {hash_md5.hexdigest()}")
@@ -68,7 +161,15 @@ def calculate_md5_internal(pathname: Path, n_retries: Optional[int] = AUTO, _ope
             raise
 
 
-example_hash = "cefd9e43b97405a7a09628501004a0cb"
+_read_buffers = threading.local()
+
+
+def _read_buffer() -> memoryview:
+    """The buffer that calculate_md5_internal() reads files into on this thread."""
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _read_buffers.buffer = memoryview(bytearray(READ_BLOCK_SIZE))
+    return buffer
 
 
 class hash_wrapper:
@@ -78,12 +179,17 @@ class hash_wrapper:
     def hexdigest(self):
         return self._hexdigest
 
+    def digest(self):
+        return bytes.fromhex(self._hexdigest)
+
 
-def calculate_md5_certutil(pathname: Path, n_retries: Optional[int] = AUTO) -> Any:
+def calculate_md5_certutil(pathname: Path, n_retries: Optional[int] = AUTO, algorithm: str = DEFAULT_ALGORITHM) -> Any:
     # certutil -hashfile <file> MD5
     if not (pathname.exists()):
         raise FileNotFoundError(f"Cannot calculate MD5 for file that is not found: {pathname}")
-    process = subprocess.run(["certutil", "-hashfile", str(pathname), "MD5"], capture_output=True)
+    certutil_name = algorithm.upper()
+    n_digits = 2 * hashlib.new(algorithm).digest_size
+    process = subprocess.run(["certutil", "-hashfile", str(pathname), certutil_name], capture_output=True)
     stdout = process.stdout
     stderr = process.stderr
     returnvalue = process.returncode
@@ -92,25 +198,30 @@ def calculate_md5_certutil(pathname: Path, n_retries: Optional[int] = AUTO) -> A
             # This error comes up for a zero-length file.  Let's verify that's the case and
             # provide a default.
             if pathname.stat().st_size == 0:
-                return hashlib.md5()
+                return hashlib.new(algorithm)
         raise RuntimeError(f"MD5 calculation failed on file: {pathname}\n{stdout.decode()}\n{stderr.decode()}")
     try:
         data = stdout.decode("cp1252").replace("\r\n", "\n").replace("\n\r", "\n")
         lines = data.split("\n")
         if len(lines) != 4:
             raise RuntimeError(f"Expected certutil -hashfile command to output exactly 4 lines.")
-        if "MD5" not in lines[0]:
-            raise RuntimeError(f"Expected certutil -hashfile MD5 command to output a first line containing 'MD5'.")
+        if certutil_name not in lines[0]:
+            raise RuntimeError(
+                f"Expected certutil -hashfile {certutil_name} command to output a first line containing '{certutil_name}'."
+            )
         hashcode = lines[1]
-        if len(hashcode) != len(example_hash):
+        if len(hashcode) != n_digits:
             raise RuntimeError(
-                f"Expected certutil -hashfile MD5 command to output a hash code of {len(example_hash)} digits, but received {len(hashcode)} digits instead: {hashcode}"
+                f"Expected certutil -hashfile {certutil_name} command to output a hash code of {n_digits} digits, but received {len(hashcode)} digits instead: {hashcode}"
             )
         # print(f"certutil has exited with code: 0x{returnvalue:08x}")
         # print(f"STDOUT:\n{stdout}")
         # print(f"STDERR:\n{stderr}")
         return hash_wrapper(hashcode)
     except Exception as ex:
+        # Only imported here, since symlinks.py loads kernel32 when it is imported.
+        from . import symlinks
+
         if symlinks.islink(str(pathname)):
             raise FileNotFoundError(f"Cannot calculate MD5 for symlink/reparse point: {pathname}")
 
@@ -122,15 +233,30 @@ def calculate_md5(
     fname: PathOrStr,
     n_retries: Optional[int] = AUTO,
     _open_fcn=open,
+    algorithm: str = DEFAULT_ALGORITHM,
+    use_certutil: bool = False,
 ) -> Any:
     """Calculate the MD5 of a single file.  n_retries should normally be AUTO, but
-    can specify a fixed number of retries allowed for the file."""
-    pathname = Path(dirname) / fname
+    can specify a fixed number of retries allowed for the file.  Another of the
+    ALGORITHMS can be used in place of MD5.  The file is read here unless
+    use_certutil is set, in which case Windows' certutil calculates it instead."""
+    return calculate_file_md5(Path(dirname) / fname, n_retries, _open_fcn, algorithm, use_certutil)
+
+
+def calculate_file_md5(
+    pathname: PathOrStr,
+    n_retries: Optional[int] = AUTO,
+    _open_fcn=open,
+    algorithm: str = DEFAULT_ALGORITHM,
+    use_certutil: bool = False,
+) -> Any:
+    """As calculate_md5(), for a caller that already has the file's full path."""
     try:
-        if _open_fcn != open:
-            return calculate_md5_internal(pathname, n_retries, _open_fcn)
+        # Starting a certutil process costs far more than hashing a small file, so it is only used on request.
+        if use_certutil and _open_fcn == open and algorithm in CERTUTIL_ALGORITHMS:
+            return calculate_md5_certutil(Path(pathname), n_retries, algorithm)
         else:
-            return calculate_md5_certutil(pathname, n_retries)
+            return calculate_md5_internal(pathname, n_retries, _open_fcn, algorithm)
 
     except KeyboardInterrupt:
         logger.info(f"User abort (keyboard interrupt) while calculating checksum for file: {pathname}")
@@ -146,37 +272,60 @@ def record_summary(record: dict):
     record tree.
     """
 
-    ret = "{"
+    ret = ["{"]
     for key in record:
         if key == "subdirectories":
             subdirectories = record[key]
-            ret += f"\n\t{key}: subdirectories: "
+            ret.append(f"\n\t{key}: subdirectories: ")
             if len(subdirectories) < 10:
-                ret += ", ".join([name for name in subdirectories])
+                ret.append(", ".join([name for name in subdirectories]))
             else:
-                ret += f"{str(len(record[key]))} subdirectories (not shown)"
+                ret.append(f"{str(len(record[key]))} subdirectories (not shown)")
         else:
-            ret += f"\n\t{key}: {str(record[key])}"
-    ret += "\n}"
-    return ret
+            ret.append(f"\n\t{key}: {str(record[key])}")
+    ret.append("\n}")
+    return "".join(ret)
+
+
+def enumerate_dir(dir: Path, exclude: Collection[str] = ()) -> Tuple[list, list]:
+    """Perform the basic enumeration of files and folders within a directory.  Any
+    files named in exclude are left out."""
 
+    file_entries, subdirectories = enumerate_dir_entries(dir, exclude)
+    return [entry.name for entry in file_entries], subdirectories
 
-def enumerate_dir(dir: Path) -> Tuple[list, list]:
-    """Perform the basic enumeration of files and folders within a directory."""
+
+def enumerate_dir_entries(dir: Path, exclude: Collection[str] = ()) -> Tuple[list, list]:
+    """As enumerate_dir(), but the files are given as the os.DirEntry objects from the
+    listing.  On Windows, their stat() comes from the listing too rather than costing
+    another call per file, which is slow on network drives."""
 
     subdirectories = []
     files = []
-    for name in os.listdir(dir):
-        if os.path.isdir(dir / name):
-            subdirectories.append(name)
-        else:
-            files.append(name)
+    # scandir() learns whether each entry is a directory while listing it, so there is no
+    # need for a separate stat per entry.  Like os.path.isdir(), is_dir() follows symlinks.
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirectories.append(entry.name)
+            elif entry.name not in exclude:
+                files.append(entry)
     # The order we calculate an MD5 hash matters, I believe, so sort them to be consistent.
-    files.sort()
+    files.sort(key=_entry_name)
     subdirectories.sort()
     return files, subdirectories
 
 
+def _entry_name(entry: os.DirEntry) -> str:
+    return entry.name
+
+
+# The record file that --calculate writes at the top of a tree, which is not itself part of the
+# tree, and the temporary file that it is written to first.
+TEMP_SUFFIX = ".tmp"
+RECORD_FILE_EXCLUDE = frozenset(["tree_checksum.json", "tree_checksum.json" + TEMP_SUFFIX])
+
+
 def find_checksum_file(starting: Path):
     """If the user requests information or comparison about a folder, a first
     step will be to check whether there is a record file in the folder or at
@@ -184,19 +333,65 @@ def find_checksum_file(starting: Path):
     tree of the folder for a record file.  It returns None if there is no
     record file found.
     """
-    attempt = starting / "tree_checksum.json"
-    if attempt.exists():
-        return attempt
-    if starting.resolve() == starting.parent.resolve():
-        # 'starting' is already the root...
-        return None
-    return find_checksum_file(starting.parent)
+    # The parents are worked out from the path itself, so no resolve() is needed to know when
+    # the root (or, for a relative path, the current directory) has been reached.
+    for folder in (starting, *starting.parents):
+        attempt = folder / "tree_checksum.json"
+        if attempt.exists():
+            return attempt
+    return None
 
 
 def read_checksum_file(checksum_file: Path) -> dict:
     """Read a record file."""
-    with open(checksum_file, "rt") as fh:
-        return json.load(fh)
+    with open(checksum_file, "rb") as fh:
+        if orjson is not None and os.fstat(fh.fileno()).st_size > 0:
+            # orjson can parse straight from a mapping of the file, which saves holding a copy
+            # of a large record file in memory alongside the record parsed from it.
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                try:
+                    return orjson.loads(view)
+                except orjson.JSONDecodeError:
+                    # orjson rejects the escaped names that are not valid Unicode, which
+                    # _json_dumps() writes and json reads back.
+                    return json.loads(view.tobytes())
+        contents = fh.read()
+    # Record files are UTF-8.  json takes the bytes as they are.
+    return json.loads(contents)
+
+
+def _json_dumps(record: dict, pretty: bool) -> bytes:
+    """Encodes a record with json, in the same format as orjson where it can."""
+    # The options give the same UTF-8 text as orjson, so the record file does not depend on
+    # which is installed.
+    separators = (",", ": ") if pretty else (",", ":")
+    indent = 2 if pretty else None
+    try:
+        return json.dumps(record, indent=indent, separators=separators, ensure_ascii=False).encode("utf-8")
+    except UnicodeEncodeError:
+        # Windows allows file names that are not valid Unicode (lone surrogates), which cannot be
+        # written as UTF-8.  Escaping everything outside ASCII keeps them.
+        return json.dumps(record, indent=indent, separators=separators).encode("ascii")
+
+
+def write_checksum_file(checksum_file: Path, record: dict, pretty: bool = True):
+    """Write a record file, indented for reading if pretty is set.  The record is
+    written to a temporary file alongside that then replaces the record file, so an
+    interruption part way through cannot leave a damaged record behind."""
+    temp_file = checksum_file.with_name(checksum_file.name + TEMP_SUFFIX)
+    contents = None
+    if orjson is not None:
+        try:
+            contents = orjson.dumps(record, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except orjson.JSONEncodeError:
+            # orjson cannot encode a name that is not valid Unicode, which json can.
+            contents = None
+    if contents is None:
+        # Encoding it all at once is faster than letting json.dump() write it piece by piece.
+        contents = _json_dumps(record, pretty)
+    with open(temp_file, "wb") as outfile:
+        outfile.write(contents)
+    os.replace(temp_file, checksum_file)
 
 
 def extract_record(root_record: dict, checksum_file: Path, target_path: Path) -> Tuple:
@@ -214,25 +409,26 @@ def extract_record(root_record: dict, checksum_file: Path, target_path: Path) ->
     """
 
     def descend_toward(target: tuple, base_record: dict):
+        records = []
+        record = base_record
         try:
-            # print(f"Descending toward: {target}")
-            next_target = target[0]
-            if next_target not in base_record["subdirectories"]:
-                raise RuntimeError(
-                    f"While searching for the subdirectory entry for: {target_path}"
-                    + f"\nIn checksum record file: {checksum_file}"
-                    + f"\nThe subdirectory: {next_target}"
-                    + f"\nWas not found in the record.  The checksum record might be out-of-date."
-                )
-            next_record = base_record["subdirectories"][next_target]
-            if len(target) == 1:
-                return [next_record]
-            return [next_record] + descend_toward(target[1:], next_record)
+            for next_target in target:
+                # print(f"Descending toward: {next_target}")
+                if next_target not in record["subdirectories"]:
+                    raise RuntimeError(
+                        f"While searching for the subdirectory entry for: {target_path}"
+                        + f"\nIn checksum record file: {checksum_file}"
+                        + f"\nThe subdirectory: {next_target}"
+                        + f"\nWas not found in the record.  The checksum record might be out-of-date."
+                    )
+                record = record["subdirectories"][next_target]
+                records.append(record)
+            return records
         except Exception as ex:
             raise RuntimeError(
                 str(ex)
-                + f"\nWhile descending records toward: {target}"
-                + f"\nFrom base record: \n{record_summary(base_record)}"
+                + f"\nWhile descending records toward: {target[len(records):]}"
+                + f"\nFrom base record: \n{record_summary(record)}"
             ) from ex
 
     logger.debug(f"target_path = {target_path}")
@@ -252,9 +448,9 @@ def print_file(fname: PathOrStr, pretty_json: Optional[bool] = None):
     if pretty_json is None:
         pretty_json = fname.suffix.lower() == ".json"
     print(f"Contents of file: {fname} {'[json] ' if pretty_json else ''}----")
-    with open(str(fname), "rt") as fh:
-        if pretty_json:
-            print(json.dumps(json.load(fh), indent=4))
-        else:
-            print(fh.read())
+    contents = fname.read_bytes()
+    if pretty_json:
+        print(json.dumps(json.loads(contents), indent=4))
+    else:
+        print(contents.decode("utf-8", errors="replace"))
     print(f"--------")
@@ -1,21 +1,71 @@
-import json
+import ctypes
 import logging
 import os
 import shutil
 from pathlib import Path
-from time import perf_counter
-from typing import Union
+from typing import Optional, Union
 
 from tqdm import tqdm
 
 from .calculate import Calculator
-from .helpers import enumerate_dir, extract_record, find_checksum_file, print_file, read_checksum_file
+from .helpers import (
+    RECORD_FILE_EXCLUDE,
+    enumerate_dir,
+    extract_record,
+    find_checksum_file,
+    print_file,
+    read_checksum_file,
+    record_algorithm,
+    record_hashing,
+    record_rollup,
+    write_checksum_file,
+)
 
 logger = logging.getLogger(__name__)
 
 PathOrStr = Union[Path, str]
 
 
+def copy_file(src: Path, dst: Path):
+    """Copies a file over any existing one.  On Windows, CopyFileW() copies the
+    contents within the system rather than through a Python read/write loop, and
+    also keeps the file's attributes and modification time."""
+    if os.name == "nt":
+        # Only imported here, since symlinks.py loads kernel32 when it is imported.
+        from . import symlinks
+
+        if not symlinks.kernel32.CopyFileW(str(src), str(dst), False):
+            raise ctypes.WinError(ctypes.get_last_error())
+    else:
+        shutil.copy(src, dst)
+
+
+def _listed_md5(listing: dict, path: Path, name: str) -> Optional[str]:
+    """The checksum of a file from a record's file listing, provided that the file's
+    size and modification time still match the listing.  Otherwise None."""
+    listed = listing.get(name)
+    if listed is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_size != listed["size"] or stat.st_mtime != listed["last-modified-at"]:
+        return None
+    return listed["MD5"]
+
+
+def _has_file_listing(record: dict) -> bool:
+    """Whether any folder within the record has a file listing."""
+    stack = [record]
+    while stack:
+        record = stack.pop()
+        if "file-listing" in record:
+            return True
+        stack.extend(record.get("subdirectories", {}).values())
+    return False
+
+
 def update_copy(source: Path, destination: Path, dry_run: bool = False):
     """Perform an update of the destination path from the source with the
     tree inventory as a resource to minimize the effort."""
@@ -49,6 +99,12 @@ def update_copy(source: Path, destination: Path, dry_run: bool = False):
         dst_subrecord = dst_record
         """
 
+    if record_hashing(src_record) != record_hashing(dst_record):
+        raise RuntimeError(
+            f"The checksums for SRC were calculated with {record_hashing(src_record)} but those for DST with"
+            + f" {record_hashing(dst_record)}.  Recalculate one of them with --new before --update."
+        )
+
     if src_rel_path != dst_rel_path:
         raise RuntimeError(
             f"After locating the subdirectory of interest in trees A and B, the relative paths do not match:"
@@ -56,8 +112,16 @@ def update_copy(source: Path, destination: Path, dry_run: bool = False):
             + f"\n\tRelative path DST: {dst_rel_path}"
         )
 
-    with tqdm(total=1) as progress:
-        calc = Calculator(True, False)
+    with tqdm(total=1, mininterval=1.0) as progress:
+        # If the destination was calculated with --detail-files, the file listings are rebuilt as each
+        # folder is recalculated, since update_branch trusts them to describe the files on disk.
+        detail_files = _has_file_listing(dst_subrecord)
+        calc = Calculator(True, detail_files, algorithm=record_algorithm(dst_record), rollup=record_rollup(dst_record))
+        # Whether dst_record has changed since it was last saved, other than through the files
+        # counted in calc.files_done.  While files are only being copied it does not change, so
+        # an occasion then has nothing to save.
+        dirty = False
+        files_done_saved = 0
 
         def update_branch(
             SRC_path: Path,
@@ -66,108 +130,144 @@ def update_copy(source: Path, destination: Path, dry_run: bool = False):
             DST_record: dict,
             level: int,
         ):
-            if (
-                "MD5" in DST_record
-                and "n_files" in DST_record
-                and SRC_record["MD5"] == DST_record["MD5"]
-                and SRC_record["n_files"] == DST_record["n_files"]
-            ):
-                return
-
-            ## Update files, if needed
-
-            if "MD5-files_only" not in DST_record or DST_record["MD5-files_only"] != SRC_record["MD5-files_only"]:
-                SRC_files, _ = enumerate_dir(SRC_path)
-                DST_files, _ = enumerate_dir(DST_path)
-
-                for name in SRC_files:
-                    if level == 0 and name == "tree_checksum.json":
-                        # Skip the file that we created ourselves, but only at the top-level.
-                        continue
-                    src_file = SRC_path / name
-                    dst_file = DST_path / name
-                    if dry_run:
-                        verb = "overwrite" if dst_file.exists() else "copy"
-                        logger.info(f"\tWould {verb} file: {src_file} -> {dst_file}")
+            nonlocal dirty
+
+            # The tree is walked with an explicit stack rather than by recursion, so its depth is
+            # not limited by Python's recursion limit.  Each folder goes back on the stack beneath
+            # its subdirectories, so that its record is recalculated after theirs.
+            stack = [(SRC_path, DST_path, SRC_record, DST_record, level, False)]
+            while stack:
+                SRC_path, DST_path, SRC_record, DST_record, level, finishing = stack.pop()
+                if finishing:
+                    # Having copied the files and subtrees, update the destination record.
+                    if not (dry_run):
+                        dirty = True
+                        calc.calculate_branch(DST_record, DST_path, level)
+                    continue
+
+                if (
+                    "MD5" in DST_record
+                    and "n_files" in DST_record
+                    and SRC_record["MD5"] == DST_record["MD5"]
+                    and SRC_record["n_files"] == DST_record["n_files"]
+                ):
+                    continue
+
+                ## Update files, if needed
+
+                if "MD5-files_only" not in DST_record or DST_record["MD5-files_only"] != SRC_record["MD5-files_only"]:
+                    # Skip the file that we created ourselves, but only at the top-level.
+                    exclude = RECORD_FILE_EXCLUDE if level == 0 else ()
+                    SRC_files, _ = enumerate_dir(SRC_path, exclude)
+                    DST_files, _ = enumerate_dir(DST_path, exclude)
+
+                    # A set, so that checking each destination file is not a scan of the listing.
+                    SRC_names = set(SRC_files)
+                    DST_names = set(DST_files)
+                    # With --detail-files, the records give each file's checksum.  A file that the
+                    # destination already holds is not copied again, and a destination file that is
+                    # about to be removed is renamed instead if it holds what a source file needs.
+                    # A checksum is only trusted while the file's size and time match the listing.
+                    SRC_listing = SRC_record.get("file-listing", {})
+                    DST_listing = DST_record.get("file-listing", {})
+                    unwanted = {}
+                    for name in DST_files:
+                        if name not in SRC_names:
+                            dst_md5 = _listed_md5(DST_listing, DST_path / name, name)
+                            if dst_md5 is not None:
+                                unwanted.setdefault(dst_md5, []).append(name)
+                    renamed = set()
+
+                    for name in SRC_files:
+                        src_file = SRC_path / name
+                        dst_file = DST_path / name
+                        src_md5 = _listed_md5(SRC_listing, src_file, name)
+                        dst_md5 = _listed_md5(DST_listing, dst_file, name) if name in DST_names else None
+                        if src_md5 is not None and src_md5 == dst_md5:
+                            continue
+                        if unwanted.get(src_md5):
+                            old_file = DST_path / unwanted[src_md5].pop()
+                            renamed.add(old_file.name)
+                            if dry_run:
+                                logger.info(f"\tWould rename file: {old_file} -> {dst_file}")
+                            else:
+                                logger.info(f"\tRenaming file: {old_file} -> {dst_file}")
+                                os.replace(old_file, dst_file)
+                        elif dry_run:
+                            verb = "overwrite" if dst_file.exists() else "copy"
+                            logger.info(f"\tWould {verb} file: {src_file} -> {dst_file}")
+                        else:
+                            copy_file(src_file, dst_file)
+                        calc._check_occasion()
+
+                    for name in DST_files:
+                        if name not in SRC_names and name not in renamed:
+                            rm_path = DST_path / name
+                            if dry_run:
+                                logger.info(f"\tWould remove file: {rm_path}")
+                            else:
+                                logger.info(f"\tRemoving file: {rm_path}")
+                                os.remove(rm_path)
+                        calc._check_occasion()
+
+                ## Update directories
+
+                stack.append((SRC_path, DST_path, SRC_record, DST_record, level, True))
+                SRC_subdirectories = SRC_record["subdirectories"] if "subdirectories" in SRC_record else {}
+                DST_subdirectories = DST_record["subdirectories"] if "subdirectories" in DST_record else {}
+                print(f"\nSRC_path = {SRC_path}")
+                print(f"SRC_subdirectories = {SRC_subdirectories.keys()}")
+                print(f"DST_subdirectories = {DST_subdirectories.keys()}")
+                branches = []
+                for name in SRC_subdirectories:
+                    src_subrecord = SRC_subdirectories[name]
+                    if name not in DST_subdirectories:
+                        from_dir = SRC_path / name
+                        to_dir = DST_path / name
+                        logger.debug(f"Copying {from_dir} -> {to_dir}")
+                        shutil.copytree(from_dir, to_dir)
                     else:
-                        shutil.copy(src_file, dst_file)
-                    if perf_counter() - calc.last_occasion > calc.between_occasions:
-                        calc._do_occasion()
-
-                for name in DST_files:
-                    if level == 0 and name == "tree_checksum.json":
-                        # Skip the file that we created ourselves, but only at the top-level.
-                        continue
-                    if name not in SRC_files:
+                        dst_subrecord = DST_subdirectories[name]
+                        branches.append(
+                            (SRC_path / name, DST_path / name, src_subrecord, dst_subrecord, level + 1, False)
+                        )
+                # Reversed, so that the first subdirectory comes off the stack first.
+                stack.extend(reversed(branches))
+                removed = []
+                for name in DST_subdirectories:
+                    if name not in SRC_subdirectories:
                         rm_path = DST_path / name
                         if dry_run:
-                            logger.info(f"\tWould remove file: {rm_path}")
+                            logger.info(f"Would remove tree: {rm_path}")
                         else:
-                            logger.info(f"\tRemoving file: {rm_path}")
-                            os.remove(rm_path)
-                    if perf_counter() - calc.last_occasion > calc.between_occasions:
-                        calc._do_occasion()
-
-            ## Update directories
-
-            SRC_subdirectories = SRC_record["subdirectories"] if "subdirectories" in SRC_record else {}
-            DST_subdirectories = DST_record["subdirectories"] if "subdirectories" in DST_record else {}
-            print(f"\nSRC_path = {SRC_path}")
-            print(f"SRC_subdirectories = {SRC_subdirectories.keys()}")
-            print(f"DST_subdirectories = {DST_subdirectories.keys()}")
-            for name in SRC_subdirectories:
-                src_subrecord = SRC_subdirectories[name]
-                if name not in DST_subdirectories:
-                    from_dir = SRC_path / name
-                    to_dir = DST_path / name
-                    logger.debug(f"Copying {from_dir} -> {to_dir}")
-                    shutil.copytree(from_dir, to_dir)
-                else:
-                    dst_subrecord = DST_subdirectories[name]
-                    update_branch(
-                        SRC_path / name,
-                        DST_path / name,
-                        src_subrecord,
-                        dst_subrecord,
-                        level + 1,
-                    )
-            removed = []
-            for name in DST_subdirectories:
-                if name not in SRC_subdirectories:
-                    rm_path = DST_path / name
-                    if dry_run:
-                        logger.info(f"Would remove tree: {rm_path}")
-                    else:
-                        logger.info(f"Removing tree: {rm_path}")
-                        shutil.rmtree(rm_path)
-                    removed.append(name)
-            for key in removed:
-                DST_subdirectories.pop(key)
-
-            # Having copied the files and subtrees, update the destination record.
-            if not (dry_run):
-                calc.calculate_branch(DST_record, DST_path, level)
-            return
+                            logger.info(f"Removing tree: {rm_path}")
+                            shutil.rmtree(rm_path)
+                        removed.append(name)
+                for key in removed:
+                    DST_subdirectories.pop(key)
+                    dirty = True
 
         def save_record():
             nonlocal dst_record
 
             logger.info(f"Saving checksum to file: {dst_record_file}")
-            with open(dst_record_file, "wt") as outfile:
-                json.dump(dst_record, outfile)
+            write_checksum_file(dst_record_file, dst_record, pretty=False)
 
         def on_occasion():
-            nonlocal progress, calc
+            nonlocal progress, calc, dirty, files_done_saved
 
             progress.total = calc.total_files
-            progress.n = calc.files_done
-            progress.refresh()
+            progress.update(calc.files_done - progress.n)
 
-            save_record()
+            if dirty or calc.files_done != files_done_saved:
+                dirty = False
+                files_done_saved = calc.files_done
+                save_record()
 
         calc.on_occasion = on_occasion
         print_file(src_record_file)
         print_file(dst_record_file)
         update_branch(source, destination, src_subrecord, dst_subrecord, 0)
+    calc.close()
     save_record()
     logger.info(f"Done.")
@@ -7,6 +7,7 @@ from typing import Union
 from .actions.calculate import calculate_tree
 from .actions.compare import compare_trees
 from .actions.find_duplicates import find_duplicates
+from .actions.helpers import ALGORITHMS
 from .actions.update import update_copy
 
 logger = logging.getLogger(__name__)
@@ -14,79 +15,119 @@ logger = logging.getLogger(__name__)
 PathOrStr = Union[Path, str]
 
 
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Tool for collecting MD5 hashes of directory trees and selective copying",
+        epilog="Note: if you apply --calculate on a directory within a tree that has already been calculated, then"
+        + " that directory will be recalculated from scratch and the result updated within the parent tree records,"
+        + " unless --new is also used.",
+    )
+    parser.add_argument(
+        "--calculate",
+        type=str,
+        default=None,
+        help="Calculate the MD5 hash of the specified path and tree",
+    )
+    parser.add_argument(
+        "--new",
+        dest="start_new",
+        action="store_true",
+        help="Do not utilize existing calculations.",
+    )
+    parser.add_argument(
+        "--continue",
+        dest="continue_previous",
+        action="store_true",
+        help="Perform calculation only on unfinished parts of previous calculation.",
+    )
+    parser.add_argument(
+        "--algorithm",
+        choices=ALGORITHMS,
+        default=None,
+        help="Hash algorithm for a new record file (default: md5).  An existing record file keeps its algorithm.",
+    )
+    parser.add_argument(
+        "--trust-mtime",
+        action="store_true",
+        help="With --calculate, keep the checksum of a file whose size and modification time are unchanged"
+        + " since the existing record instead of reading it again.  Implies --detail-files.",
+    )
+    parser.add_argument(
+        "--count-first",
+        action="store_true",
+        help="With --calculate, count the files in the tree in the background so that the progress bar"
+        + " shows the true total.  This lists every folder a second time.",
+    )
+    parser.add_argument(
+        "--certutil",
+        action="store_true",
+        help="With --calculate, hash files with Windows' certutil rather than reading them directly.  This is"
+        + " much slower for small files but gives the same checksums.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("A", "B"),
+        help="Compare checksum records for two paths and identify differences.",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=2,
+        help="Maximum depth for comparing two trees.",
+    )
+    parser.add_argument(
+        "--emit-events",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="With --compare, also write each difference found to PATH as a JSON object per line.",
+    )
+    parser.add_argument(
+        "--update",
+        type=str,
+        nargs=2,
+        default=None,
+        metavar=("source", "destination"),
+        help="Update the tree from [source] to [destination] where MD5s do not match.",
+    )
+    parser.add_argument(
+        "--find-duplicates",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="Identify the largest duplicate folders within the path and save to duplicates.csv.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="A listing of all changes will be produced but no changes made.",
+    )
+    parser.add_argument(
+        "--detail-files",
+        action="store_true",
+        help="Capture detailed file listings in the record file.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Perform the operation with specified number of threads where supported.  0 picks a number"
+        + " of threads for this machine.",
+    )
+    parser.add_argument("-v", "--v", action="store_true", help="Increase verbosity.")
+    return parser
+
+
+# Built once, so that a caller running main() many times does not rebuild it each time.
+_PARSER = _build_parser()
+
+
 def main(args):
     try:
-        parser = argparse.ArgumentParser(
-            description="Tool for collecting MD5 hashes of directory trees and selective copying",
-            epilog="Note: if you apply --calculate on a directory within a tree that has already been calculated, then"
-            + " that directory will be recalculated from scratch and the result updated within the parent tree records,"
-            + " unless --new is also used.",
-        )
-        parser.add_argument(
-            "--calculate",
-            type=str,
-            default=None,
-            help="Calculate the MD5 hash of the specified path and tree",
-        )
-        parser.add_argument(
-            "--new",
-            dest="start_new",
-            action="store_true",
-            help="Do not utilize existing calculations.",
-        )
-        parser.add_argument(
-            "--continue",
-            dest="continue_previous",
-            action="store_true",
-            help="Perform calculation only on unfinished parts of previous calculation.",
-        )
-        parser.add_argument(
-            "--compare",
-            type=str,
-            nargs=2,
-            default=None,
-            metavar=("A", "B"),
-            help="Compare checksum records for two paths and identify differences.",
-        )
-        parser.add_argument(
-            "--depth",
-            type=int,
-            default=2,
-            help="Maximum depth for comparing two trees.",
-        )
-        parser.add_argument(
-            "--update",
-            type=str,
-            nargs=2,
-            default=None,
-            metavar=("source", "destination"),
-            help="Update the tree from [source] to [destination] where MD5s do not match.",
-        )
-        parser.add_argument(
-            "--find-duplicates",
-            type=str,
-            default=None,
-            metavar="PATH",
-            help="Identify the largest duplicate folders within the path and save to duplicates.csv.",
-        )
-        parser.add_argument(
-            "--dry-run",
-            action="store_true",
-            help="A listing of all changes will be produced but no changes made.",
-        )
-        parser.add_argument(
-            "--detail-files",
-            action="store_true",
-            help="Capture detailed file listings in the record file.",
-        )
-        parser.add_argument(
-            "--parallel",
-            type=int,
-            default=1,
-            help="Perform the operation with specified number of threads where supported.",
-        )
-        parser.add_argument("-v", "--v", action="store_true", help="Increase verbosity.")
-        args = parser.parse_args(args)
+        args = _PARSER.parse_args(args)
 
         if args.v:
             for handler in logging.getLogger().handlers:
@@ -104,13 +145,18 @@ def main(args):
                 args.detail_files,
                 args.parallel,
                 args.v,
+                args.algorithm,
+                args.trust_mtime,
+                args.count_first,
+                args.certutil,
             )
         elif args.update is not None:
             source, destination = args.update
             update_copy(Path(source), Path(destination), dry_run=args.dry_run)
         elif args.compare is not None:
             source, destination = args.compare
-            compare_trees(Path(source), Path(destination), depth=args.depth)
+            events_file = Path(args.emit_events) if args.emit_events is not None else None
+            compare_trees(Path(source), Path(destination), depth=args.depth, events_file=events_file)
         elif args.find_duplicates is not None:
             target = args.find_duplicates
             find_duplicates(Path(target))